@@ -1,22 +1,26 @@
 import requests
+from requests.adapters import HTTPAdapter
 import mimetypes
 import os
-from logs.logging_setup import setup_run_logger
 import logging
 from pathlib import Path
-from dotenv import load_dotenv
+
+from api import journal
+from api import transport
+from api.multipart import MultipartFileStream
+from sync import metrics
 
 import re
 import json
+import threading
+import time
 
 
-# Set up logging
-logfile = setup_run_logger(level="DEBUG")
+# Logging is set up once per run by runlog.setup()
 log = logging.getLogger(__name__)
 
-# Load environment variables from .env file
+# Repository root (.env is loaded from here by the entry point, see cli.py)
 ROOT = Path(__file__).resolve().parents[3]
-load_dotenv(ROOT / ".env")
 
 
 # Create a new session
@@ -24,69 +28,223 @@ def new_session():
     return requests.Session()
 
 
-# Login to Specify API
-def api_login():#, username, password, collection_id):
-    session = new_session()
-
-    log.info(f"Logging in to Specify API using {os.getenv("API_USER")}...")
+# Log the given session in to Specify API (CSRF GET + login PUT)
+# Returns True on success
+def _login(session):
+    log.info("Logging in to Specify API using %s...", os.getenv("API_USER"))
     endpoint = "/context/login/"
     login_url = os.getenv("API_DOMAIN") + endpoint   
     
     # Get CSRF token
-    get_response = session.get(login_url)
+    get_response = transport.request(session, "GET", login_url, allow_relogin=False)
     csrf_token_login = get_response.cookies.get('csrftoken')
     login_info = {'username': os.getenv("API_USER"), 'password': os.getenv("API_PASS"), 'collection': int(os.getenv("API_COLLECTIONID"))}
     headers = {"X-CSRFToken": csrf_token_login}
 
-    response = session.put(login_url, json=login_info, headers=headers)
+    response = transport.request(session, "PUT", login_url, json=login_info, headers=headers, allow_relogin=False)
     if response.status_code == 204:
         log.info("Login successful.")
-        return session
+        return True
     else:
-        log.error(f"Login failed with status code {response.status_code}.")
+        log.error("Login failed with status code %s.", response.status_code)
         if response.text:
-            log.error(f"Response text: {response.text}")
+            log.error("Response text: %s", response.text)
+        return False
+
+
+# Saved session cookies, SESSION_COOKIES in .env (default .specify_session.json next to .env)
+def _cookies_path():
+    return Path(os.getenv("SESSION_COOKIES") or ROOT / ".specify_session.json")
+
+
+# Who the saved cookies belong to, they are only reused for the same server, user and collection
+def _session_owner():
+    return {"domain": os.getenv("API_DOMAIN"), "user": os.getenv("API_USER"), "collection": os.getenv("API_COLLECTIONID")}
+
+
+# Save the session cookies, readable by the current user only
+def _save_cookies(session):
+    saved = {
+        "owner": _session_owner(),
+        "cookies": [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires, "secure": c.secure}
+            for c in session.cookies
+        ],
+    }
+    path = _cookies_path()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(saved, f)
+        os.chmod(path, 0o600)
+    except OSError as e:
+        log.warning("Could not save session cookies: %s", e)
+
+
+# Load saved cookies into the session, returns True if there were any for this server/user/collection
+def _load_cookies(session):
+    try:
+        with _cookies_path().open(encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if saved.get("owner") != _session_owner():
+        return False
+    now = time.time()
+    for c in saved.get("cookies", []):
+        if c["expires"] is not None and c["expires"] < now:
+            continue
+        session.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"], expires=c["expires"], secure=c["secure"])
+    return bool(session.cookies.get("sessionid"))
+
+
+# Check that the session is still logged in
+def _session_valid(session):
+    url = os.getenv("API_DOMAIN") + "/context/user.json"
+    try:
+        response = transport.request(session, "GET", url, allow_relogin=False)
+    except Exception:
+        return False
+    return response.status_code == 200
+
+
+_relogin_lock = threading.Lock()
+
+# Log in again after the session expired (called by transport.request on 401/403)
+# seen_generation is the login generation the failed request was sent with; if another
+# worker logged in again meanwhile, the request is just replayed
+def _relogin(session, seen_generation):
+    with _relogin_lock:
+        if session.login_generation != seen_generation:
+            return True
+        log.warning("Specify session expired, logging in again...")
+        if not _login(session):
+            return False
+        session.login_generation += 1
+        _save_cookies(session)
+        return True
+
+
+# Login to Specify API
+# Saved cookies are reused when the session is still valid, and the session logs in again
+# by itself (once per failed request) when it expires during a run
+def api_login():#, username, password, collection_id):
+    session = new_session()
+
+    if _load_cookies(session) and _session_valid(session):
+        log.info("Reusing saved Specify session.")
+    else:
+        session.cookies.clear()
+        if not _login(session):
             return None
+        _save_cookies(session)
+
+    session.login_generation = 0
+    session.relogin = lambda seen_generation: _relogin(session, seen_generation)
+    return session
     
 
 # Get upload token for uploading file by file name
 # Returns csrf token
 def api_file_token(session, filename):
-    log.info(f"Getting attachment token for {filename}...")
+    log.info("Getting attachment token for %s...", filename)
     params = {"filename": filename}
     att_token = "/attachment_gw/get_token/"
     att_token_url = os.getenv("API_DOMAIN") + att_token
-    response = session.get(att_token_url,params=params)
+    response = transport.request(session, "GET", att_token_url,params=params)
     if response.status_code != 200:
-        log.error(f"Failed to get attachment token with status code {response.status_code}.")
+        log.error("Failed to get attachment token with status code %s.", response.status_code)
     else:
         log.info("successfully got attachment token.")
-        log.info(f"Response: {response.text}")
+        log.debug("Response: %s", response.text)
     csrf_token_tok = response.text
     return csrf_token_tok
 
-# Get params for uploading file
-# Returns attachmentLocation, token
-def api_get_upload_params(session, filename):
-    endp = "/attachment_gw/get_upload_params/"
-    url_attachment = os.getenv("API_DOMAIN") + endp
-    
-    params = {"filenames": [filename]}
-    
-    headers = {
+def _upload_params_headers(session):
+    return {
         "Accept": "application/json",
         "Referer": os.getenv("API_DOMAIN") + "/specify/view/collectionobject/0001000000/",
         "Origin": os.getenv("API_DOMAIN"),
         "X-CSRFToken": session.cookies.get("csrftoken"),
     }
-    
-    response = session.post(url_attachment, json=params, headers=headers)
-    json_response = response.json()[0]
-    attachmentLocation = json_response["attachmentLocation"]
-    log.info(f"Attachment location: {attachmentLocation}")
-    with open(os.getenv("ATT_LOCATION"), "a", encoding="utf-8") as f:
-        f.write(f"\n{attachmentLocation}\n")
-    token = json_response["token"]
+
+
+# Get params for uploading many files with a single request
+# Returns list of (attachmentLocation, token) in the same order as filenames, or None on failure
+def api_get_upload_params_bulk(session, filenames):
+    log.info("Getting upload params for %s files...", len(filenames))
+    endp = "/attachment_gw/get_upload_params/"
+    url_attachment = os.getenv("API_DOMAIN") + endp
+
+    params = {"filenames": list(filenames)}
+
+    response = transport.request(session, "POST", url_attachment, json=params, headers=_upload_params_headers(session))
+    if response.status_code != 200:
+        log.error("Failed to get upload params with status code %s.", response.status_code)
+        return None
+    return [(item["attachmentLocation"], item["token"]) for item in response.json()]
+
+
+# Prefetched upload params, filename -> list of (attachmentLocation, token, fetched at)
+_upload_params_pool = {}
+_upload_params_lock = threading.Lock()
+
+# Drop the pooled params older than ttl, e.g. prefetched for files that were skipped in the end
+def _purge_upload_params_locked(ttl):
+    now = time.monotonic()
+    for filename in list(_upload_params_pool):
+        entries = [entry for entry in _upload_params_pool[filename] if now - entry[2] < ttl]
+        if entries:
+            _upload_params_pool[filename] = entries
+        else:
+            del _upload_params_pool[filename]
+
+
+# Request upload params for many files ahead of time, UPLOAD_PARAMS_BATCH (default 100) filenames per request
+# The params are handed out by api_get_upload_params; expired ones are purged from the pool first
+def prefetch_upload_params(session, filenames):
+    filenames = list(filenames)
+    batch_size = int(os.getenv("UPLOAD_PARAMS_BATCH", "100"))
+    with _upload_params_lock:
+        _purge_upload_params_locked(int(os.getenv("UPLOAD_PARAMS_TTL", "120")))
+    for i in range(0, len(filenames), batch_size):
+        batch = filenames[i:i + batch_size]
+        upload_params = api_get_upload_params_bulk(session, batch)
+        if upload_params is None:
+            continue
+        fetched_at = time.monotonic()
+        with _upload_params_lock:
+            for filename, (attachmentLocation, token) in zip(batch, upload_params):
+                _upload_params_pool.setdefault(filename, []).append((attachmentLocation, token, fetched_at))
+
+
+# Take prefetched params for filename from the pool
+# Tokens older than UPLOAD_PARAMS_TTL seconds (default 120) are dropped, the asset server rejects old tokens
+def _take_upload_params(filename):
+    ttl = int(os.getenv("UPLOAD_PARAMS_TTL", "120"))
+    with _upload_params_lock:
+        entries = _upload_params_pool.get(filename)
+        while entries:
+            attachmentLocation, token, fetched_at = entries.pop(0)
+            if time.monotonic() - fetched_at < ttl:
+                return attachmentLocation, token
+        _upload_params_pool.pop(filename, None)
+    return None
+
+
+# Get params for uploading file, from the prefetched pool when available
+# Returns attachmentLocation, token
+def api_get_upload_params(session, filename):
+    upload_params = _take_upload_params(filename)
+    if upload_params is None:
+        fetched = api_get_upload_params_bulk(session, [filename])
+        if not fetched:
+            return None, None
+        upload_params = fetched[0]
+    attachmentLocation, token = upload_params
+    log.info("Attachment location: %s", attachmentLocation)
+    # Every location handed out is journaled, so unused or failed uploads can be cleaned up later
+    journal.record(attachmentLocation, filename=filename, status="issued")
 
     return attachmentLocation, token
 
@@ -97,19 +255,52 @@ def api_get_upload_settings(session):
     log.info("Getting upload settings...")
     att_set_endpoint = "/attachment_gw/get_settings/"
     att_set_url = os.getenv("API_DOMAIN") + att_set_endpoint
-    response = session.get(att_set_url)
+    response = transport.request(session, "GET", att_set_url)
     if response.status_code != 200:
-        log.error(f"Failed to get upload settings with status code {response.status_code}.")
+        log.error("Failed to get upload settings with status code %s.", response.status_code)
         return None
     else:
         log.info("Successfully got upload settings.")
         return response.json()
 
 
+_upload_settings_lock = threading.Lock()
+
+# Get upload settings once per session and reuse them for UPLOAD_SETTINGS_TTL seconds (default 3600)
+# refresh=True forces a new request, e.g. after an upload to the asset server failed
+def get_upload_settings(session, refresh=False):
+    with _upload_settings_lock:
+        cached = getattr(session, "upload_settings_cache", None)
+        if cached and not refresh and time.monotonic() < cached[1]:
+            return cached[0]
+        upload_settings = api_get_upload_settings(session)
+        if upload_settings is not None:
+            ttl = int(os.getenv("UPLOAD_SETTINGS_TTL", "3600"))
+            session.upload_settings_cache = (upload_settings, time.monotonic() + ttl)
+        return upload_settings
+
+
+_asset_session = None
+_asset_session_lock = threading.Lock()
+
+# Shared keep-alive session for the asset server, ASSET_POOL_SIZE (default 10) connections per host
+def asset_server_session():
+    global _asset_session
+    with _asset_session_lock:
+        if _asset_session is None:
+            pool_size = int(os.getenv("ASSET_POOL_SIZE", "10"))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _asset_session = session
+        return _asset_session
+
+
 # Upload file to asset server
+# The file is streamed from disk in chunks and closed when the upload is done
 def asset_server_upload_attachment(wr, file_path, attachmentLocation, token, collection_asset):
-    log.info(f"Uploading {file_path} to asset server...")
-    files = {"file": open(file_path, "rb")}
+    log.info("Uploading %s to asset server...", file_path)
     data = {
         "token": token,
         "store": attachmentLocation,
@@ -117,9 +308,10 @@ def asset_server_upload_attachment(wr, file_path, attachmentLocation, token, col
         "coll": collection_asset,
     }
 
-    response = requests.post(wr, files=files, data=data)
+    with MultipartFileStream(data, "file", file_path) as body:
+        response = transport.request(asset_server_session(), "POST", wr, data=body, headers={"Content-Type": body.content_type})
     if response.status_code != 200:
-        log.error(f"Failed to upload to asset server with status code {response.status_code}.")
+        log.error("Failed to upload to asset server with status code %s.", response.status_code)
         return
     else:
         log.info("---> Successfully uploaded to asset server.")
@@ -127,7 +319,7 @@ def asset_server_upload_attachment(wr, file_path, attachmentLocation, token, col
 
 ### CURRENTLY NOT NEEDED  ###
 def asset_server_delete_attachment(delete_from_asset_url, attachmentLocation, collection_asset, delete_token):
-    log.info(f"Deleting {attachmentLocation} from asset server...")
+    log.info("Deleting %s from asset server...", attachmentLocation)
         
     data = {
         "token": delete_token,
@@ -136,22 +328,22 @@ def asset_server_delete_attachment(delete_from_asset_url, attachmentLocation, co
         "filename": attachmentLocation,
     }
 
-    response = requests.post(delete_from_asset_url, data=data)
+    response = transport.request(asset_server_session(), "POST", delete_from_asset_url, data=data)
     if response.status_code != 200:
-        log.error(f"Failed to delete file from asset server with status code {response.status_code}.")
-        log.error(f"Response text: {response.text}")
+        log.error("Failed to delete file from asset server with status code %s.", response.status_code)
+        log.error("Response text: %s", response.text)
         return
     else:
-        log.info(f"Successfully deleted file from asset server.")
+        log.info("Successfully deleted file from asset server.")
         return attachmentLocation
     
 
 # Create and returns attachment resource dict
 def create_attachment_resource(attachmentlocation, filename):
-    log.info(f"Creating attachment resource for {filename}...")
+    log.info("Creating attachment resource for %s...", filename)
     mimeType = mimetypes.guess_type(filename)[0]
     if mimeType is None:
-        log.warning(f"Could not determine MIME type for {filename}. Using 'application/octet-stream' as default.")
+        log.warning("Could not determine MIME type for %s. Using 'application/octet-stream' as default.", filename)
         mimeType = "application/octet-stream"
     attachmentResource0 = {
         "ordinal": 0,
@@ -182,20 +374,103 @@ def create_full_attachment_resource(new_attachment_resource):
     full_attachment_resources.append(new_attachment_resource)
     return full_attachment_resources
 
+# Collection objects resolved during this run, cleared by controller.sync_paths at the start of every
+# run or watch batch so versions from an earlier run are not reused
+# catalog number -> {"id": ..., "version": ..., "attachments": [...]}
+_col_obj_cache = {}
+_col_obj_lock = threading.Lock()
+
+
+# Store (or refresh) a collection object resource in the run cache
+def _cache_col_obj(col_obj):
+    entry = {
+        "id": col_obj["id"],
+        "version": col_obj["version"],
+        "attachments": col_obj.get("collectionobjectattachments", []),
+    }
+    with _col_obj_lock:
+        _col_obj_cache[col_obj["catalognumber"]] = entry
+    return entry
+
+
+# Start a new run with an empty collection object cache
+def clear_col_obj_cache():
+    with _col_obj_lock:
+        _col_obj_cache.clear()
+
+
+# Drop a cached collection object, e.g. after a failed PUT
+def forget_col_obj(cat_num):
+    with _col_obj_lock:
+        _col_obj_cache.pop(cat_num, None)
+
+
+# Resolve many catalog numbers with paged queries, COL_OBJ_BATCH (default 100) catalog numbers per query
+# Returns dict catalog number -> cached entry (None if not found)
+def resolve_col_objects(session, cat_nums):
+    cat_nums = list(dict.fromkeys(cat_nums))
+    with _col_obj_lock:
+        missing = [c for c in cat_nums if c not in _col_obj_cache]
+    batch_size = int(os.getenv("COL_OBJ_BATCH", "100"))
+    url_colobj = os.getenv("API_DOMAIN") + "/api/specify/collectionobject/"
+
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        log.info("Resolving %s collection objects by catalog number...", len(batch))
+        offset = 0
+        while True:
+            params = {
+                "catalognumber__in": ",".join(batch),
+                "collection": int(os.getenv("API_COLLECTIONID")),
+                "limit": len(batch),
+                "offset": offset,
+            }
+            response = transport.request(session, "GET", url_colobj, params=params)
+            if response.status_code != 200:
+                log.error(" !!!! Failed to resolve collection objects with status code %s.", response.status_code)
+                break
+            response_json = response.json()
+            objects = response_json["objects"]
+            for col_obj in objects:
+                _cache_col_obj(col_obj)
+            offset += len(objects)
+            if not objects or offset >= response_json["meta"]["total_count"]:
+                break
+
+    with _col_obj_lock:
+        return {c: _col_obj_cache.get(c) for c in cat_nums}
+
+
+# Get the cached collection object for a catalog number, fetching it if not resolved yet
+def get_col_obj(session, cat_num):
+    with _col_obj_lock:
+        entry = _col_obj_cache.get(cat_num)
+    if entry is None:
+        entry = resolve_col_objects(session, [cat_num]).get(cat_num)
+    return entry
+
+
 # Get collection object parameters by catalog number and collection id
 # Returns collection object id and version
 def api_get_coll_obj_params(session, cat_num, collectionid):
-    log.info(f"Getting collection object parameters for catalog number {cat_num} in collection {collectionid}...")
+    log.info("Getting collection object parameters for catalog number %s in collection %s...", cat_num, collectionid)
+    if collectionid == int(os.getenv("API_COLLECTIONID")):
+        entry = get_col_obj(session, cat_num)
+        if entry is None:
+            log.error(" !!!! No collection object found for catalog number %s.", cat_num)
+            return None, None
+        return entry["id"], entry["version"]
+
     params = {"catalognumber": cat_num, "collection": collectionid}
     endp = f"/api/specify/collectionobject/"
     url_colobj = os.getenv("API_DOMAIN") + endp
-    response = session.get(url_colobj, params=params)
-    log.debug(f"Response status code: {response.status_code}")
+    response = transport.request(session, "GET", url_colobj, params=params)
+    log.debug("Response status code: %s", response.status_code)
     if response.status_code != 200:
-        log.error(f" !!!! Failed to get collection object with status code {response.status_code}.")
+        log.error(" !!!! Failed to get collection object with status code %s.", response.status_code)
         return None, None
     if not response.json()["objects"]:
-        log.error(f" !!!! No collection object found for catalog number {cat_num}.")
+        log.error(" !!!! No collection object found for catalog number %s.", cat_num)
         return None, None
     col_obj_id = response.json()["objects"][0]["id"]
     col_obj_version = response.json()["objects"][0]["version"]
@@ -206,7 +481,7 @@ def api_get_coll_obj_params(session, cat_num, collectionid):
 
 # Upload attachment to an existing Collection Object
 def api_col_obj_attach(session, attach_resources, col_obj_id, col_obj_version):
-    log.info(f"Attaching resources to Collection Object ID {col_obj_id}...")
+    log.info("Attaching resources to Collection Object ID %s...", col_obj_id)
     ### optional - to add verification of the catalog number ###
     url_coll_obj_att = f"{os.getenv("API_DOMAIN")}/api/specify/collectionobject/{col_obj_id}/"
     headers = {
@@ -219,33 +494,82 @@ def api_col_obj_attach(session, attach_resources, col_obj_id, col_obj_version):
         "version": col_obj_version,
     }
 
-    response = session.put(url_coll_obj_att, json=json, headers=headers)
+    response = transport.request(session, "PUT", url_coll_obj_att, json=json, headers=headers)
     if response.status_code != 200:
-        log.error(f" !!!! Failed to attach file to Collection Object with status code {response.status_code}.")
-        log.error(f"Response text: {response.text}")
+        log.error(" !!!! Failed to attach file to Collection Object with status code %s.", response.status_code)
+        log.error("Response text: %s", response.text)
         return
     else:
         log.info("  ----->   Successfully attached file to Collection Object.")
+        # Keep the run cache in step with the server (new version and attachments list)
+        _cache_col_obj(response.json())
         return col_obj_id
 
 
+# Replace any attachment with the same filename and append the new one with a single PUT
+# On a version conflict (409) the collection object is read again and the change re-applied,
+# up to COL_OBJ_PUT_RETRIES times (default 3)
+# Returns collection object id, or None on failure
+def api_col_obj_replace_attach(session, cat_num, attachment_resource, filename):
+    retries = int(os.getenv("COL_OBJ_PUT_RETRIES", "3"))
+    for attempt in range(retries + 1):
+        col_obj = get_col_obj(session, cat_num)
+        if col_obj is None:
+            log.error(" !!!! No collection object found for catalog number %s.", cat_num)
+            return None
+
+        # Drop the old attachment with the same filename (if exists) and append the new one locally
+        attachments = [a for a in col_obj["attachments"]
+                       if a["attachment"]["origfilename"].casefold() != filename.casefold()]
+        replaced = len(col_obj["attachments"]) - len(attachments)
+        if replaced:
+            log.info("Replacing %s attachment(s) with filename %s on Collection Object %s.", replaced, filename, cat_num)
+        attachments.append(attachment_resource)
+
+        log.info("Attaching resources to Collection Object ID %s (version %s)...", col_obj['id'], col_obj['version'])
+        url_coll_obj_att = os.getenv("API_DOMAIN") + f"/api/specify/collectionobject/{col_obj['id']}/"
+        # Only send the attachments list and the current version to avoid updating other nested tables
+        payload = {
+            "collectionobjectattachments": attachments,
+            "version": col_obj["version"],
+        }
+        headers = {
+            "X-CSRFToken": session.cookies.get("csrftoken"),
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        response = transport.request(session, "PUT", url_coll_obj_att, json=payload, headers=headers)
+        if response.status_code == 200:
+            log.info("  ----->   Successfully attached file to Collection Object.")
+            _cache_col_obj(response.json())
+            return col_obj["id"]
+
+        # The cached copy is stale or the PUT failed, read it fresh next time
+        forget_col_obj(cat_num)
+        if response.status_code != 409:
+            log.error(" !!!! Failed to attach file to Collection Object with status code %s.", response.status_code)
+            log.error("Response text: %s", response.text)
+            return None
+        metrics.incr("col_obj_version_conflicts")
+        log.warning("Version conflict on Collection Object %s (attempt %s), retrying with a fresh read.", cat_num, attempt + 1)
+
+    log.error(" !!!! Gave up attaching %s to Collection Object %s after %s version conflicts.", filename, cat_num, retries + 1)
+    return None
+
+
 def api_col_obj_delete_attach(session, cat_number, filename, delete_from_asset_url, attachmentLocation=None):
-    params = { "catalognumber": cat_number, "collection": int(os.getenv("API_COLLECTIONID")) }
-    endp = f"/api/specify/collectionobject/"
-    url_colobj = os.getenv("API_DOMAIN") + endp
-    response = session.get(url_colobj, params=params)
-    if len(response.json()["objects"]) == 0:
-        log.error(f" !!!! No collection object found for catalog number {cat_number}.")
+    current_col_obj = get_col_obj(session, cat_number)
+    if current_col_obj is None:
+        log.error(" !!!! No collection object found for catalog number %s.", cat_number)
         return None, None
     ### getting information about attachments for this catalog number ###
-    current_col_obj_json = response.json()["objects"][0]
-    attachments =  current_col_obj_json["collectionobjectattachments"]
-    col_obj_id = current_col_obj_json["id"]
-    log.info(f"Collection Object {cat_number} ID is: {col_obj_id}")
+    attachments =  current_col_obj["attachments"]
+    col_obj_id = current_col_obj["id"]
+    log.info("Collection Object %s ID is: %s", cat_number, col_obj_id)
     attachment_location = None
 
     if not attachments:
-        log.info(f"No attachments found for Collection Object {cat_number}.")
+        log.info("No attachments found for Collection Object %s.", cat_number)
 
     else:
         for att in attachments:
@@ -258,7 +582,7 @@ def api_col_obj_delete_attach(session, cat_number, filename, delete_from_asset_u
                 continue
             if orig_filename.casefold() == filename.casefold():
                 # Delete
-                log.info(f"Found attachment {attachment_id} with filename {filename}, attachmentlocation {attachment_location} to delete.")
+                log.info("Found attachment %s with filename %s, attachmentlocation %s to delete.", attachment_id, filename, attachment_location)
 
                 col_obj_by_id_url = os.getenv("API_DOMAIN") + f"/api/specify/collectionobject/{col_obj_id}/"
 
@@ -271,24 +595,26 @@ def api_col_obj_delete_attach(session, cat_number, filename, delete_from_asset_u
                 new_attachments = [a for a in attachments if a['id'] != attachment_id]
                 attach_count_after = len(new_attachments)
                 if (attach_count_after + 1) != attach_count_before:
-                    log.error(f" !!!! Attachment count mismatch after deletion attempt. Aborting deletion of file {filename}.")
+                    log.error(" !!!! Attachment count mismatch after deletion attempt. Aborting deletion of file %s.", filename)
                     return attachment_location, attachments
                 # Only send the attachments list and the current version to avoid updating other nested tables
                 payload = {
                     "collectionobjectattachments": new_attachments,
-                    "version": current_col_obj_json.get("version"),
+                    "version": current_col_obj["version"],
                 }
                 headers = {
                     "X-CSRFToken": session.cookies.get("csrftoken"),
                     "Accept": "application/json",
                     "Content-Type": "application/json",
                 }
-                deleted_col_obj_response = session.put(col_obj_by_id_url, json=payload, headers=headers)
+                deleted_col_obj_response = transport.request(session, "PUT", col_obj_by_id_url, json=payload, headers=headers)
                 if deleted_col_obj_response.status_code != 200:
-                    log.error(f" !!!! Failed to delete img {filename} from Collection Object with status code {deleted_col_obj_response.status_code}.")
-                    log.debug(f"Response text: {deleted_col_obj_response.text}")
+                    log.error(" !!!! Failed to delete img %s from Collection Object with status code %s.", filename, deleted_col_obj_response.status_code)
+                    log.debug("Response text: %s", deleted_col_obj_response.text)
+                    forget_col_obj(cat_number)
                     return attachment_location, attachments
-                log.info(f" ---> Successfully deleted img {filename} from Collection Object.")
+                log.info(" ---> Successfully deleted img %s from Collection Object.", filename)
+                _cache_col_obj(deleted_col_obj_response.json())
                 
                 
                 ## delete_att_location = current_attachment_to_delete['attachment']['attachmentlocation']
@@ -300,81 +626,183 @@ def api_col_obj_delete_attach(session, cat_number, filename, delete_from_asset_u
     return attachment_location, attachments
 
 
+# Detach several files from one Collection Object with a single PUT
+# targets: list of (filename, attachment location or None to match any location)
+# Every attachment matching a target is removed; on a version conflict (409) the collection object
+# is read again and the targets re-applied, up to COL_OBJ_PUT_RETRIES times (default 3)
+# Returns the list of targets that were detached (empty if none matched), or None on failure
+def api_col_obj_detach_many(session, cat_num, targets):
+    retries = int(os.getenv("COL_OBJ_PUT_RETRIES", "3"))
+    for attempt in range(retries + 1):
+        col_obj = get_col_obj(session, cat_num)
+        if col_obj is None:
+            log.error(" !!!! No collection object found for catalog number %s.", cat_num)
+            return None
+
+        attachments = []
+        detached = []
+        for att in col_obj["attachments"]:
+            filename = att["attachment"]["origfilename"].casefold()
+            location = att["attachment"]["attachmentlocation"]
+            match = next((t for t in targets if t[0].casefold() == filename and t[1] in (None, location)), None)
+            if match is None:
+                attachments.append(att)
+            else:
+                log.info("Found attachment %s with filename %s, attachmentlocation %s to delete.", att["id"], match[0], location)
+                if match not in detached:
+                    detached.append(match)
+        if not detached:
+            log.info("No matching attachments found for Collection Object %s.", cat_num)
+            return []
+
+        url_coll_obj_att = os.getenv("API_DOMAIN") + f"/api/specify/collectionobject/{col_obj['id']}/"
+        # Only send the attachments list and the current version to avoid updating other nested tables
+        payload = {
+            "collectionobjectattachments": attachments,
+            "version": col_obj["version"],
+        }
+        headers = {
+            "X-CSRFToken": session.cookies.get("csrftoken"),
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        response = transport.request(session, "PUT", url_coll_obj_att, json=payload, headers=headers)
+        if response.status_code == 200:
+            log.info(" ---> Successfully deleted %s attachment(s) from Collection Object %s.",
+                     len(col_obj["attachments"]) - len(attachments), cat_num)
+            _cache_col_obj(response.json())
+            return detached
+
+        forget_col_obj(cat_num)
+        if response.status_code != 409:
+            log.error(" !!!! Failed to delete attachments from Collection Object %s with status code %s.", cat_num, response.status_code)
+            log.debug("Response text: %s", response.text)
+            return None
+        metrics.incr("col_obj_version_conflicts")
+        log.warning("Version conflict on Collection Object %s (attempt %s), retrying with a fresh read.", cat_num, attempt + 1)
+
+    log.error(" !!!! Gave up detaching from Collection Object %s after %s version conflicts.", cat_num, retries + 1)
+    return None
+
+
 ### CURRENTLY NOT NEEDED  ###
 def check_filename_attached(session, cat_num, filename):
-    log.info(f"Checking existing attachments for Collection Object {cat_num}...")
+    log.info("Checking existing attachments for Collection Object %s...", cat_num)
     endp = f"/api/specify/collectionobject/"
     url_colobj = os.getenv("API_DOMAIN") + endp
     params = { "catalognumber": cat_num, "collection": int(os.getenv("API_COLLECTIONID")) }
-    response = session.get(url_colobj, params=params)
+    response = transport.request(session, "GET", url_colobj, params=params)
 
     response_json = response.json()
     attachments =  response_json["objects"][0]["collectionobjectattachments"]
     if len(attachments) < 1:
-        log.info(f"No existing attachments found for Collection Object {cat_num}.")
+        log.info("No existing attachments found for Collection Object %s.", cat_num)
         return False
-    log.info(f"Found {len(attachments)} existing attachments.")
+    log.info("Found %s existing attachments.", len(attachments))
     for att in attachments:
-        log.info(f"Attachment ID: {att['id']}, Original Filename: {att['attachment']['origfilename']}, attachmentlocation: {att['attachment']['attachmentlocation']}")
+        log.info("Attachment ID: %s, Original Filename: %s, attachmentlocation: %s", att['id'], att['attachment']['origfilename'], att['attachment']['attachmentlocation'])
         if att['attachment']['origfilename'] == filename:
-            log.info(f"File {filename} is already attached to Collection Object {cat_num}.")
+            log.info("File %s is already attached to Collection Object %s.", filename, cat_num)
             return True
 
-def attachment_to_col_object(file_path, cat_num ,session):
-    log.info(f"---> Starting attachment process for file {file_path} to catalog number {cat_num}...")
-
+# Get upload params and settings and upload the file to the asset server
+# Returns attachmentLocation, or None on failure
+def upload_to_asset_server(file_path, session):
     filename = file_path.name
 
-    attachmentLocation, token = api_get_upload_params(session, filename)
-    upload_settings = api_get_upload_settings(session)
+    with metrics.stage("upload_params"):
+        attachmentLocation, token = api_get_upload_params(session, filename)
+    if attachmentLocation is None:
+        log.error(" !!!! Cannot proceed with attachment without upload params")
+        return None
+    with metrics.stage("upload_settings"):
+        upload_settings = get_upload_settings(session)
+    if upload_settings is None:
+        log.error(" !!!! Cannot proceed with attachment without upload settings")
+        return None
     write_to_asset_url = upload_settings["write"]
-    delete_from_asset_url = upload_settings["delete"]
     collection_asset = upload_settings["collection"]
 
-    col_obj_id, col_obj_version = api_get_coll_obj_params(session, cat_num, int(os.getenv("API_COLLECTIONID")))
-    if col_obj_id is None:
-        log.error(f" !!!! Cannot proceed with attachment")
-        return None
-    uploaded_to_asset = asset_server_upload_attachment(write_to_asset_url, file_path, attachmentLocation, token, collection_asset)
+    with metrics.stage("asset_upload"):
+        uploaded_to_asset = asset_server_upload_attachment(write_to_asset_url, file_path, attachmentLocation, token, collection_asset)
+    if not uploaded_to_asset:
+        # Settings may be stale (e.g. asset server moved), refresh them and retry once
+        log.warning("Upload of %s failed, refreshing upload settings and retrying.", file_path)
+        metrics.incr("asset_upload_retries")
+        with metrics.stage("upload_settings"):
+            upload_settings = get_upload_settings(session, refresh=True)
+        if upload_settings is not None:
+            write_to_asset_url = upload_settings["write"]
+            collection_asset = upload_settings["collection"]
+            with metrics.stage("asset_upload"):
+                uploaded_to_asset = asset_server_upload_attachment(write_to_asset_url, file_path, attachmentLocation, token, collection_asset)
     if not uploaded_to_asset:
-        log.error(f" !!!! Upload to asset server FAILED for file {file_path} to catalog number {cat_num}.")
+        log.error(" !!!! Upload to asset server FAILED for file %s.", file_path)
+        metrics.incr("asset_upload_failures")
+        journal.record(attachmentLocation, filename=filename, status="upload_failed")
         return None
-    # Currently implemented for single attachment resource
-    attachment_resource = create_attachment_resource(attachmentLocation, filename)
-    attachment_resources = [attachment_resource]   # attachment_resources is a list of attachment resources
+    metrics.incr("uploaded_bytes", file_path.stat().st_size)
+    return attachmentLocation
 
-    
 
-    # Delete the old attachment with the same filename (if exists)
-    deleted_att_location, current_attachments_list = api_col_obj_delete_attach(session, cat_num, filename, delete_from_asset_url)
-    
-    # Start with the attachments returned from deletion step
-    attachment_resources = current_attachments_list or []
-    # Build the new attachment list by appending the new resource
-    # but fetch the authoritative collection object resource first to get up-to-date versions
-    col_obj_by_id_url = os.getenv("API_DOMAIN") + f"/api/specify/collectionobject/{col_obj_id}/"
-    try:
-        col_obj_response = session.get(col_obj_by_id_url, headers={"X-CSRFToken": session.cookies.get("csrftoken")})
-    except Exception:
-        col_obj_response = None
-
-    if col_obj_response and col_obj_response.status_code == 200:
-        resource = col_obj_response.json()
-        current_list = resource.get("collectionobjectattachments", [])
-        # Use server's canonical list, then append the new attachment resource
-        current_list.append(attachment_resource)
-        attachment_resources = current_list
-        # use the authoritative version from the resource
-        col_obj_version = resource.get("version", col_obj_version)
-        log.info(f"Using collection object version from server: {col_obj_version}")
-    else:
-        # Fall back to the list we have and the previously fetched version
-        attachment_resources.append(attachment_resource)
-        log.warning("Could not fetch authoritative collection object before attaching; using local version/list.")
+def attachment_to_col_object(file_path, cat_num ,session):
+    log.info("---> Starting attachment process for file %s to catalog number %s...", file_path, cat_num)
+
+    filename = file_path.name
 
-    attached = api_col_obj_attach(session, attachment_resources, col_obj_id, col_obj_version)
+    with metrics.stage("col_obj_lookup"):
+        col_obj = get_col_obj(session, cat_num)
+    if col_obj is None:
+        log.error(" !!!! No collection object found for catalog number %s. Cannot proceed with attachment", cat_num)
+        return None
+    attachmentLocation = upload_to_asset_server(file_path, session)
+    if not attachmentLocation:
+        log.error(" !!!! Upload to asset server FAILED for file %s to catalog number %s.", file_path, cat_num)
+        return None
+    # Currently implemented for single attachment resource
+    attachment_resource = create_attachment_resource(attachmentLocation, filename)
+
+    # One read-modify-write: the old attachment with the same filename (if exists) is replaced
+    # in the same PUT, so the collection object is never left without the image
+    with metrics.stage("col_obj_put"):
+        attached = api_col_obj_replace_attach(session, cat_num, attachment_resource, filename)
     if not attached:
-        # log.error(f"Attachment process FAILED for file {file_path} to catalog number {cat_num}.")
+        # log.error("Attachment process FAILED for file %s to catalog number %s.", file_path, cat_num)
+        journal.record(attachmentLocation, filename=filename, cat_num=cat_num, status="attach_failed")
         return None
+    journal.record(attachmentLocation, filename=filename, cat_num=cat_num, status="attached")
     return attachmentLocation
 
+
+# Upload a file once and attach it to several collection objects (multi catalogue number images)
+# targets is a list of (cat_num, filename); every collection object gets its own attachment record,
+# titled with its filename, that points at the shared attachmentLocation.
+# Note: deleting one of these attachments in Specify may remove the shared asset for all of them.
+# Returns dict cat_num -> attachmentLocation (None where attaching failed)
+def attachment_to_col_objects(file_path, targets, session):
+    log.info("---> Starting shared attachment process for file %s to catalog numbers %s...", file_path, [c for c, _ in targets])
+    results = {cat_num: None for cat_num, _ in targets}
+
+    with metrics.stage("col_obj_lookup"):
+        col_objs = resolve_col_objects(session, [cat_num for cat_num, _ in targets])
+    if not any(col_objs.values()):
+        log.error(" !!!! No collection object found for any catalog number of %s. Cannot proceed with attachment", file_path.name)
+        return results
+    attachmentLocation = upload_to_asset_server(file_path, session)
+    if not attachmentLocation:
+        log.error(" !!!! Upload to asset server FAILED for file %s.", file_path)
+        return results
+
+    for cat_num, filename in targets:
+        if col_objs.get(cat_num) is None:
+            log.error(" !!!! No collection object found for catalog number %s.", cat_num)
+            continue
+        attachment_resource = create_attachment_resource(attachmentLocation, filename)
+        with metrics.stage("col_obj_put"):
+            attached = api_col_obj_replace_attach(session, cat_num, attachment_resource, filename)
+        if attached:
+            results[cat_num] = attachmentLocation
+    attached = [cat_num for cat_num, loc in results.items() if loc]
+    journal.record(attachmentLocation, filename=file_path.name, cat_num="+".join(attached) or None,
+                   status="attached" if len(attached) == len(targets) else "attach_failed")
+    return results
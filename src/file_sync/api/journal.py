@@ -0,0 +1,148 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+# Append-only JSONL journal of attachment locations handed out for upload and what became of them.
+# Entries are buffered and written in batches of JOURNAL_FLUSH_EVERY (default 50), or once the oldest
+# buffered entry is JOURNAL_FLUSH_SECONDS old (default 5); controller.sync_paths also flushes at the end
+# of every batch. The journal file (ATT_JOURNAL, default ATT_LOCATION with a .jsonl suffix) is rotated once it grows past
+# JOURNAL_MAX_BYTES (default 50 MB). A SQLite index next to it keeps the latest entry per location
+# together with the segment and byte offset of its line, so lookups do not scan the journal.
+
+_buffer = []
+_lock = threading.Lock()
+_index = None
+
+
+def journal_path() -> Path:
+    path = os.getenv("ATT_JOURNAL")
+    if path:
+        return Path(path)
+    return Path(os.getenv("ATT_LOCATION", "attachment_location.txt")).with_suffix(".jsonl")
+
+
+def _index_conn():
+    global _index
+    if _index is None:
+        path = journal_path()
+        _index = sqlite3.connect(str(path.with_suffix(".idx.sqlite3")), check_same_thread=False)
+        _index.row_factory = sqlite3.Row
+        _index.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                location TEXT PRIMARY KEY,
+                filename TEXT,
+                cat_num TEXT,
+                status TEXT,
+                ts REAL,
+                segment TEXT,
+                offset INTEGER
+            )
+            """
+        )
+        _index.execute("CREATE INDEX IF NOT EXISTS entries_status ON entries (status)")
+        _index.commit()
+    return _index
+
+
+def record(location, filename=None, cat_num=None, status=None):
+    """Buffer a journal entry for an attachment location."""
+    entry = {
+        "ts": time.time(),
+        "location": location,
+        "filename": filename,
+        "cat_num": cat_num,
+        "status": status,
+    }
+    with _lock:
+        _buffer.append(entry)
+        if len(_buffer) >= int(os.getenv("JOURNAL_FLUSH_EVERY", "50")) \
+                or entry["ts"] - _buffer[0]["ts"] >= float(os.getenv("JOURNAL_FLUSH_SECONDS", "5")):
+            _flush_locked()
+
+
+def flush():
+    """Write buffered entries to the journal and the index."""
+    with _lock:
+        _flush_locked()
+
+
+def _rotate_if_needed(path: Path):
+    max_bytes = int(os.getenv("JOURNAL_MAX_BYTES", str(50 * 1024 * 1024)))
+    if path.exists() and path.stat().st_size >= max_bytes:
+        stamp = time.strftime('%Y%m%d%H%M%S')
+        rotated = path.with_name(f"{path.stem}.{stamp}{path.suffix}")
+        n = 1
+        while rotated.exists():
+            rotated = path.with_name(f"{path.stem}.{stamp}-{n}{path.suffix}")
+            n += 1
+        path.rename(rotated)
+        # Point the index at the rotated segment
+        conn = _index_conn()
+        conn.execute("UPDATE entries SET segment = ? WHERE segment = ?", (str(rotated), str(path)))
+        conn.commit()
+
+
+def _flush_locked():
+    if not _buffer:
+        return
+    path = journal_path()
+    _rotate_if_needed(path)
+    rows = []
+    with path.open("ab") as f:
+        for entry in _buffer:
+            offset = f.tell()
+            f.write((json.dumps(entry) + "\n").encode("utf-8"))
+            rows.append((entry["location"], entry["filename"], entry["cat_num"], entry["status"],
+                         entry["ts"], str(path), offset))
+    _buffer.clear()
+
+    conn = _index_conn()
+    # Keep filename / catalog number from earlier entries when a later entry does not repeat them
+    conn.executemany(
+        """
+        INSERT INTO entries (location, filename, cat_num, status, ts, segment, offset)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (location) DO UPDATE SET
+            filename = COALESCE(excluded.filename, filename),
+            cat_num = COALESCE(excluded.cat_num, cat_num),
+            status = excluded.status,
+            ts = excluded.ts,
+            segment = excluded.segment,
+            offset = excluded.offset
+        """,
+        rows,
+    )
+    conn.commit()
+
+
+def lookup(location):
+    """Latest indexed entry for a location as a dict, or None."""
+    flush()
+    row = _index_conn().execute("SELECT * FROM entries WHERE location = ?", (location,)).fetchone()
+    return dict(row) if row else None
+
+
+def locations(status=None):
+    """Indexed locations, optionally only those whose latest status is status (e.g. for cleanup)."""
+    flush()
+    if status is None:
+        rows = _index_conn().execute("SELECT location FROM entries")
+    else:
+        rows = _index_conn().execute("SELECT location FROM entries WHERE status = ?", (status,))
+    return [row["location"] for row in rows]
+
+
+def read_entry(segment, offset):
+    """Read back the journal line the index points at."""
+    with open(segment, "rb") as f:
+        f.seek(offset)
+        return json.loads(f.readline())
+
+
+atexit.register(flush)
@@ -0,0 +1,79 @@
+import mimetypes
+import os
+import uuid
+from pathlib import Path
+
+
+class MultipartFileStream:
+    """
+    multipart/form-data body with plain form fields and one file, read from disk in chunks.
+    Pass it as `data=` to requests (with `content_type` as the Content-Type header) so the
+    file is streamed with a known Content-Length instead of being loaded into memory.
+    """
+
+    def __init__(self, fields: dict, file_field: str, file_path: str | Path):
+        file_path = Path(file_path)
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+        head = b""
+        for name, value in fields.items():
+            head += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode("utf-8")
+        mime_type = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+        head += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{file_path.name}"\r\n'
+            f"Content-Type: {mime_type}\r\n\r\n"
+        ).encode("utf-8")
+        self._head = head
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+        self._file = file_path.open("rb")
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        self._length = len(self._head) + self._file_size + len(self._tail)
+        self._pos = 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            size = self._length - self._pos
+        out = b""
+        while size > 0 and self._pos < self._length:
+            file_start = len(self._head)
+            file_end = file_start + self._file_size
+            if self._pos < file_start:
+                chunk = self._head[self._pos:self._pos + size]
+            elif self._pos < file_end:
+                chunk = self._file.read(min(size, file_end - self._pos))
+                if not chunk:
+                    raise IOError("File shrank while it was being uploaded")
+            else:
+                offset = self._pos - file_end
+                chunk = self._tail[offset:offset + size]
+            out += chunk
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return out
+
+    def seek(self, offset, whence=0):
+        """Only rewinding is supported, so a failed upload can be sent again."""
+        if offset != 0 or whence != 0:
+            raise ValueError("MultipartFileStream can only be rewound to the start")
+        self._file.seek(0)
+        self._pos = 0
+        return 0
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
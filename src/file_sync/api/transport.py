@@ -0,0 +1,199 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import logging
+
+import requests
+
+
+# Shared request layer for the Specify API and the asset server:
+#   - retries with jittered exponential backoff on 5xx, 429 and connection errors
+#     (HTTP_RETRIES, default 4; HTTP_BACKOFF base seconds, default 0.5; HTTP_BACKOFF_MAX, default 30)
+#     Retry-After is honoured up to HTTP_BACKOFF_MAX as well
+#   - a token bucket per host (RATE_LIMIT requests/sec, default 20, 0 to disable; RATE_BURST, default RATE_LIMIT)
+#     whose rate is halved on 429 and recovers step by step on success
+#   - a circuit breaker per host that pauses all callers for BREAKER_COOLDOWN seconds (default 30)
+#     after BREAKER_THRESHOLD consecutive failures (default 5), doubling the pause while the host stays down
+#   - once the retries are used up on connection errors, the request keeps waiting for the host to come
+#     back for up to HTTP_OUTAGE_WAIT seconds (default 600) before giving up with HostUnavailable
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HostUnavailable(requests.ConnectionError):
+    """The host did not answer for longer than HTTP_OUTAGE_WAIT, the request was given up."""
+
+
+class TokenBucket:
+    """Token bucket with an adaptive rate: halved on throttling, recovered by 10% per success."""
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.max_rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; while open every caller waits until the cooldown is over."""
+
+    def __init__(self, host, threshold, cooldown):
+        self.host = host
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and time.monotonic() >= self.open_until:
+                log.error(" !!!! %s looks down after %s failures, pausing requests for %.0f seconds.", self.host, self.failures, self.cooldown)
+                self.open_until = time.monotonic() + self.cooldown
+                self.cooldown = min(self.cooldown * 2, self.base_cooldown * 16)
+
+    def success(self):
+        with self.lock:
+            if self.failures >= self.threshold:
+                log.info("%s is responding again.", self.host)
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def _host_state(host):
+    with _hosts_lock:
+        if host not in _hosts:
+            rate = float(os.getenv("RATE_LIMIT", "20"))
+            burst = float(os.getenv("RATE_BURST", str(max(rate, 1))))
+            breaker = CircuitBreaker(host, int(os.getenv("BREAKER_THRESHOLD", "5")), float(os.getenv("BREAKER_COOLDOWN", "30")))
+            _hosts[host] = (TokenBucket(rate, burst), breaker)
+        return _hosts[host]
+
+
+def _backoff(attempt, retry_after=None):
+    cap = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+    if retry_after is not None:
+        try:
+            # The server's value is honoured up to the same cap
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    base = float(os.getenv("HTTP_BACKOFF", "0.5"))
+    # Full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def request(session, method, url, allow_relogin=True, **kwargs):
+    """
+    session.request with retries, per-host rate limiting and circuit breaking.
+    A streamed body (data with seek) is rewound before every retry.
+    On 401/403 a session with a relogin hook (see client.api_login) logs in again once and
+    the request is replayed with the new CSRF token; allow_relogin=False turns this off.
+    Returns the last response. Connection errors past the retries wait out the host's outage
+    (see HTTP_OUTAGE_WAIT) and then raise HostUnavailable.
+    """
+    host = urlsplit(url).netloc
+    bucket, breaker = _host_state(host)
+    retries = int(os.getenv("HTTP_RETRIES", "4"))
+    outage_wait = float(os.getenv("HTTP_OUTAGE_WAIT", "600"))
+    kwargs.setdefault("timeout", (10, float(os.getenv("HTTP_TIMEOUT", "300"))))
+    relogin = getattr(session, "relogin", None) if allow_relogin else None
+
+    attempt = 0
+    sent = False
+    outage_since = None
+    while attempt <= retries:
+        login_generation = getattr(session, "login_generation", 0)
+        breaker.wait()
+        bucket.acquire()
+        body = kwargs.get("data")
+        if sent and hasattr(body, "seek"):
+            body.seek(0)
+        sent = True
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.failure()
+            if attempt < retries:
+                delay = _backoff(attempt)
+                log.warning("%s %s failed (%s), retrying in %.1f seconds.", method, url, e.__class__.__name__, delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            # Retries used up: keep trying (paced by the open breaker) until the outage wait is over
+            if outage_since is None:
+                outage_since = time.monotonic()
+                log.error(" !!!! %s %s still failing (%s), waiting up to %.0f seconds for %s to come back.",
+                          method, url, e.__class__.__name__, outage_wait, host)
+            waited = time.monotonic() - outage_since
+            if waited >= outage_wait:
+                raise HostUnavailable(f"{host} unreachable for {waited:.0f} seconds, gave up {method} {url}") from e
+            time.sleep(min(_backoff(attempt), outage_wait - waited))
+            continue
+
+        if response.status_code in (401, 403) and relogin is not None:
+            # Only once per request
+            relogin, do_relogin = None, relogin
+            if do_relogin(login_generation):
+                headers = kwargs.get("headers")
+                if headers and "X-CSRFToken" in headers:
+                    kwargs["headers"] = {**headers, "X-CSRFToken": session.cookies.get("csrftoken")}
+                continue
+            return response
+
+        if response.status_code not in RETRY_STATUSES:
+            breaker.success()
+            bucket.succeeded()
+            return response
+
+        if response.status_code == 429:
+            bucket.throttled()
+        else:
+            breaker.failure()
+        if attempt == retries:
+            return response
+        delay = _backoff(attempt, response.headers.get("Retry-After"))
+        log.warning("%s %s returned %s, retrying in %.1f seconds.", method, url, response.status_code, delay)
+        time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,183 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+# Local stand-in for the Specify endpoints and the asset server used by the sync:
+#   /context/login/, /context/user.json, /attachment_gw/get_settings/, /attachment_gw/get_upload_params/,
+#   /api/specify/collectionobject/ (list, get, versioned put) and the asset server write/delete URLs.
+# Every catalog number exists. Each request waits `latency` seconds and fails with 503 at `error_rate`.
+
+COL_OBJ_URL = re.compile(r"^/api/specify/collectionobject/(\d+)/$")
+
+
+class FakeSpecify:
+    def __init__(self, latency=0.0, error_rate=0.0, upload_latency=None):
+        self.latency = latency
+        self.upload_latency = latency if upload_latency is None else upload_latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.col_objs = {}   # id -> resource
+        self.by_cat_num = {}
+        self.next_id = 1
+        self.requests = 0
+        self.uploaded_bytes = 0
+
+    def col_obj(self, cat_num):
+        with self.lock:
+            if cat_num not in self.by_cat_num:
+                col_obj_id = self.next_id
+                self.next_id += 1
+                self.col_objs[col_obj_id] = {
+                    "id": col_obj_id,
+                    "catalognumber": cat_num,
+                    "version": 0,
+                    "collectionobjectattachments": [],
+                    "resource_uri": f"/api/specify/collectionobject/{col_obj_id}/",
+                }
+                self.by_cat_num[cat_num] = col_obj_id
+            return self.col_objs[self.by_cat_num[cat_num]]
+
+    def put_col_obj(self, col_obj_id, payload):
+        with self.lock:
+            resource = self.col_objs.get(col_obj_id)
+            if resource is None:
+                return 404, {}
+            if payload.get("version") != resource["version"]:
+                return 409, {"error": "stale version"}
+            attachments = []
+            for att in payload.get("collectionobjectattachments", []):
+                att = dict(att)
+                att.setdefault("id", self.next_id)
+                self.next_id += 1
+                attachments.append(att)
+            resource["collectionobjectattachments"] = attachments
+            resource["version"] += 1
+            return 200, resource
+
+
+def make_handler(state: FakeSpecify, base_url):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes; without TCP_NODELAY every reply waits
+        # for the client's delayed ACK (~40 ms) and the benchmark measures that instead of the sync
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            remaining = length
+            data = b""
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if length < 1024 * 1024:
+                    data += chunk
+            return data, length
+
+        def _reply(self, status, body=None, cookies=()):
+            payload = b"" if body is None else json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for cookie in cookies:
+                self.send_header("Set-Cookie", cookie)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _start(self, latency):
+            with state.lock:
+                state.requests += 1
+            if latency:
+                time.sleep(latency)
+            return random.random() >= state.error_rate
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            if not self._start(state.latency):
+                return self._reply(503, {"error": "injected"})
+            if url.path == "/context/login/":
+                return self._reply(200, {}, cookies=["csrftoken=benchcsrf; Path=/"])
+            if url.path == "/context/user.json":
+                return self._reply(200 if "sessionid" in self.headers.get("Cookie", "") else 403, {"id": 1})
+            if url.path == "/attachment_gw/get_settings/":
+                return self._reply(200, {
+                    "read": base_url + "/web_asset_store/getfileref",
+                    "write": base_url + "/web_asset_store/fileupload",
+                    "delete": base_url + "/web_asset_store/filedelete",
+                    "collection": "bench",
+                })
+            if url.path == "/api/specify/collectionobject/":
+                cat_nums = []
+                if "catalognumber__in" in query:
+                    cat_nums = query["catalognumber__in"][0].split(",")
+                elif "catalognumber" in query:
+                    cat_nums = query["catalognumber"]
+                objects = [state.col_obj(c) for c in cat_nums]
+                offset = int(query.get("offset", ["0"])[0])
+                limit = int(query.get("limit", ["20"])[0])
+                return self._reply(200, {
+                    "objects": objects[offset:offset + limit],
+                    "meta": {"limit": limit, "offset": offset, "total_count": len(objects)},
+                })
+            m = COL_OBJ_URL.match(url.path)
+            if m and int(m.group(1)) in state.col_objs:
+                return self._reply(200, state.col_objs[int(m.group(1))])
+            return self._reply(404, {})
+
+        def do_PUT(self):
+            url = urlsplit(self.path)
+            data, _ = self._body()
+            if not self._start(state.latency):
+                return self._reply(503, {"error": "injected"})
+            if url.path == "/context/login/":
+                return self._reply(204, cookies=["sessionid=benchsession; Path=/", "csrftoken=benchcsrf; Path=/"])
+            m = COL_OBJ_URL.match(url.path)
+            if m:
+                status, body = state.put_col_obj(int(m.group(1)), json.loads(data or b"{}"))
+                return self._reply(status, body)
+            return self._reply(404, {})
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            data, length = self._body()
+            if url.path == "/web_asset_store/fileupload":
+                if not self._start(state.upload_latency):
+                    return self._reply(503, {"error": "injected"})
+                with state.lock:
+                    state.uploaded_bytes += length
+                return self._reply(200, {})
+            if not self._start(state.latency):
+                return self._reply(503, {"error": "injected"})
+            if url.path == "/attachment_gw/get_upload_params/":
+                filenames = json.loads(data or b"{}").get("filenames", [])
+                return self._reply(200, [
+                    {"attachmentLocation": uuid.uuid4().hex + "." + name.rsplit(".", 1)[-1], "token": "benchtoken"}
+                    for name in filenames
+                ])
+            if url.path == "/web_asset_store/filedelete":
+                return self._reply(200, {})
+            return self._reply(404, {})
+
+    return Handler
+
+
+def serve(port, latency=0.0, error_rate=0.0, upload_latency=None, ready=None):
+    """Run the fake server until the process is stopped. ready (an Event) is set once it listens."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), None)
+    server.daemon_threads = True
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.RequestHandlerClass = make_handler(FakeSpecify(latency, error_rate, upload_latency), base_url)
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
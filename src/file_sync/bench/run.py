@@ -0,0 +1,147 @@
+"""
+End-to-end benchmark of controller.sync_files against the local fake Specify / asset server.
+
+Run from src/file_sync:
+    python -m bench.run --files 500 --workers 8 --latency 0.02 --error-rate 0.01
+
+Reports files/sec, p50/p99 per-file latency and peak RSS of the sync process.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from bench import fake_specify
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def generate_jpegs(scan_dir: Path, count, size, multi_every):
+    """Write count JPEGs named after 10 digit catalogue numbers; every multi_every-th one is an A+B sheet."""
+    from PIL import Image
+
+    rng = random.Random(0)
+    for i in range(count):
+        img = Image.frombytes("RGB", (size, size), rng.randbytes(size * size * 3))
+        cat_num = f"{9000000000 + i:010d}"
+        if multi_every and i % multi_every == 0:
+            name = f"{cat_num}+{9100000000 + i:010d}.jpg"
+        else:
+            name = f"{cat_num}.jpg"
+        img.save(scan_dir / name, quality=90)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1024, help="image width/height in pixels")
+    parser.add_argument("--multi-every", type=int, default=0, help="make every Nth file a multi catalogue number sheet")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every Specify request")
+    parser.add_argument("--upload-latency", type=float, default=None, help="seconds added to every asset upload")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--rate-limit", default="0", help="RATE_LIMIT for the run (0 disables the limiter)")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    work = Path(tempfile.mkdtemp(prefix="file_sync_bench_"))
+    scan_dir = work / "scan"
+    uploaded_dir = work / "uploaded"
+    scan_dir.mkdir()
+    uploaded_dir.mkdir()
+    generate_jpegs(scan_dir, args.files, args.size, args.multi_every)
+    total_bytes = sum(p.stat().st_size for p in scan_dir.iterdir())
+
+    port = _free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=fake_specify.serve,
+        args=(port, args.latency, args.error_rate, args.upload_latency, ready),
+        daemon=True,
+    )
+    server.start()
+    ready.wait(10)
+
+    # The bench does not load .env, the whole configuration comes from here
+    os.environ.update({
+        "API_DOMAIN": f"http://127.0.0.1:{port}",
+        "API_USER": "bench",
+        "API_PASS": "bench",
+        "API_COLLECTIONID": "4",
+        "SCAN_DIR": str(scan_dir),
+        "UPLOADED_DIR": str(uploaded_dir),
+        "ATT_JOURNAL": str(work / "journal.jsonl"),
+        "STATE_DB": str(work / "state.sqlite3"),
+        "SESSION_COOKIES": str(work / "session.json"),
+        "SYNC_WORKERS": str(args.workers),
+        "RATE_LIMIT": args.rate_limit,
+    })
+    import runlog
+    from sync import controller
+
+    runlog.setup()
+
+    latencies = []
+    process_file = controller.process_file
+
+    def timed_process_file(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return process_file(*a, **kw)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    controller.process_file = timed_process_file
+
+    start = time.perf_counter()
+    controller.sync_files(workers=args.workers)
+    elapsed = time.perf_counter() - start
+    server.terminate()
+
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    report = {
+        "files": args.files,
+        "bytes": total_bytes,
+        "workers": args.workers,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "uploaded": len(list(uploaded_dir.iterdir())),
+        "elapsed_s": round(elapsed, 3),
+        "files_per_s": round(args.files / elapsed, 2) if elapsed else None,
+        "p50_file_s": round(_percentile(latencies, 50), 4),
+        "p99_file_s": round(_percentile(latencies, 99), 4),
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1) if peak_rss else None,
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,110 @@
-from api import client
-from sync import controller
-from sync import helpers
-from sync import fixes
-
+import argparse
 import os
+from pathlib import Path
+
+# Only argparse and the standard library are imported up front; each subcommand imports the
+# modules it needs (requests, Pillow, pandas, ...) so "--help" and short commands start fast.
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def load_env():
+    """Load .env from the repository root (variables already set are kept)."""
+    from dotenv import load_dotenv
+    load_dotenv(ROOT / ".env")
+
+
+def cmd_sync(args):
+    from sync import controller
+    controller.sync_files(workers=args.workers)
+
+
+# Keeps running and syncs new scans as they land
+def cmd_watch(args):
+    from sync import watcher
+    watcher.watch(workers=args.workers)
+
+
+# One scan of SCAN_DIR for all the verification reports
+def cmd_audit(args):
+    from sync import audit
+    audit.run(reports=args.reports or audit.REPORTS, export=args.export)
+
+
+# Mirror the collection's attachments locally and report how SCAN_DIR differs from it
+def cmd_inventory(args):
+    from sync import inventory
+    inventory.reconcile(report_csv=args.report, full=args.full, no_refresh=args.no_refresh)
+
+
+# Build the action plan for SCAN_DIR without changing anything, or run the stored plan
+def cmd_plan(args):
+    from sync import planner
+    if args.execute:
+        planner.log_summary(planner.execute(batch_size=args.batch_size, workers=args.workers))
+    else:
+        planner.plan(report_csv=args.report, no_refresh=args.no_refresh)
+
+
+def cmd_fix(args):
+    from sync import fixes
+    if args.fix == "unattach":
+        fixes.fix_delete_image_id_and_unattach()
+    elif args.fix == "move-uploaded":
+        fixes.move_uploaded_files(args.scan_dir or os.getenv("SCAN_DIR"))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Sync scanned files to Specify attachments.")
+    parser.add_argument("--log-level", help="log level for the run (default LOG_LEVEL or INFO)")
+    # "python cli.py" without a subcommand keeps doing a single sync
+    parser.set_defaults(func=cmd_sync, workers=None)
+    commands = parser.add_subparsers(dest="command")
+
+    sync = commands.add_parser("sync", help="upload and attach the files in SCAN_DIR once (default)")
+    sync.add_argument("--workers", type=int, help="parallel uploads (default SYNC_WORKERS or 1)")
+    sync.set_defaults(func=cmd_sync)
+
+    watch = commands.add_parser("watch", help="keep watching SCAN_DIR and sync new files")
+    watch.add_argument("--workers", type=int, help="parallel uploads (default SYNC_WORKERS or 1)")
+    watch.set_defaults(func=cmd_watch)
+
+    audit = commands.add_parser("audit", help="write the attachment verification CSV reports")
+    audit.add_argument("--report", dest="reports", action="append", choices=("att_loc_exist", "files_list", "check_files"),
+                       help="report to write, may be repeated (default all)")
+    audit.add_argument("--export", action="store_true",
+                       help="also write the check_files statuses back into attachment_list.csv")
+    audit.set_defaults(func=cmd_audit)
+
+    inventory = commands.add_parser("inventory", help="refresh the local mirror of Specify and diff it with SCAN_DIR")
+    inventory.add_argument("--full", action="store_true", help="download everything again, also drops deleted records")
+    inventory.add_argument("--no-refresh", action="store_true", help="diff against the mirror as it is")
+    inventory.add_argument("--report", help="diff CSV to write (default inventory_diff.csv next to .env)")
+    inventory.set_defaults(func=cmd_inventory)
+
+    plan = commands.add_parser("plan", help="plan a sync of SCAN_DIR (dry run), or run the stored plan")
+    plan.add_argument("--execute", action="store_true", help="run the pending actions of the stored plan (resumes)")
+    plan.add_argument("--no-refresh", action="store_true", help="plan against the inventory mirror as it is")
+    plan.add_argument("--report", help="also write the plan as CSV to this file")
+    plan.add_argument("--batch-size", type=int, help="actions per batch when executing (default PLAN_BATCH or 100)")
+    plan.add_argument("--workers", type=int, help="parallel uploads (default SYNC_WORKERS or 1)")
+    plan.set_defaults(func=cmd_plan)
+
+    fix = commands.add_parser("fix", help="repair attachments")
+    fix.add_argument("fix", choices=("unattach", "move-uploaded"),
+                     help="unattach: detach the rows of tofix.xlsx; move-uploaded: move files with an Image ID")
+    fix.add_argument("--scan-dir", help="directory for move-uploaded (default SCAN_DIR)")
+    fix.set_defaults(func=cmd_fix)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    load_env()
+    import runlog
+    runlog.setup(args.log_level)
+    args.func(args)
 
-def main():
-    controller.sync_files()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
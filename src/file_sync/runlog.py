@@ -0,0 +1,72 @@
+import atexit
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from logs.logging_setup import setup_run_logger
+
+
+# Run logging: set up once per run by the entry point (cli.py, bench) instead of at module import.
+# The run logger's handlers are moved behind a queue and written by a background thread, so the
+# sync workers never wait on file or console I/O.
+#   LOG_LEVEL         level for the run (default INFO)
+#   LOG_DEBUG_SAMPLE  fraction of DEBUG records kept when LOG_LEVEL=DEBUG (default 1.0)
+
+_listener = None
+_logfile = None
+
+
+class DebugSampler(logging.Filter):
+    """Keep only a fraction of DEBUG records; other levels always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """Hand records over unformatted, the listener thread does the % formatting."""
+
+    def prepare(self, record):
+        return record
+
+
+def setup(level=None):
+    """Set up the run logger behind a queue. Returns what setup_run_logger returns (the log file)."""
+    global _listener, _logfile
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    if _listener is not None:
+        # Already set up for this process, only change the level
+        logging.getLogger().setLevel(level)
+        return _logfile
+    logfile = _logfile = setup_run_logger(level=level)
+
+    root = logging.getLogger()
+    handlers = [h for h in root.handlers if not isinstance(h, QueueHandler)]
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(DebugSampler(float(os.getenv("LOG_DEBUG_SAMPLE", "1.0"))))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+    return logfile
+
+
+def stop():
+    """Flush queued records and stop the background thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,211 @@
+import csv
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from sync import controller
+from sync import refstore
+from sync import scanner
+from sync import validators
+
+
+# Audit of SCAN_DIR against the reference CSVs, shared by the three verification reports:
+#   att_loc_exist  attachment_list_att_loc_exist.csv, files with an Image ID found in the DB and asset lists
+#   files_list     files_list.csv, every file with its Image ID checked against attachment_list_updated.csv
+#   check_files    status column of attachment_list.csv updated, unknown Image IDs in attachment_list_missing.csv
+# The directory is scanned once and the Image IDs are read AUDIT_WORKERS (default 8) files at a time.
+# The reference CSVs are looked up through the indexed store in refstore.py, which re-imports a CSV
+# only when it changed; check_files keeps its statuses there (cli.py audit --export writes them back).
+
+log = logging.getLogger(__name__)
+
+ATTACHMENT_LIST_CSV = Path(r"Z:\Data\Herbarium\VascularPlants\attachment_list.csv")
+ATTACHMENT_LIST_UPDATED_CSV = Path(r"Z:\Data\Herbarium\VascularPlants\attachment_list_updated.csv")
+ASSET_ATT_LOC_CSV = Path(r"Z:\images\herbarium\asset_att_loc.csv")
+FILES_LIST_CSV = Path(r"Z:\Data\Herbarium\VascularPlants\image_upload_verification\files_list.csv")
+
+REPORTS = ("att_loc_exist", "files_list", "check_files")
+
+IMAGE_ID_REGEX = re.compile(r"(?:ImageID|Image ID)\s*:\s*(\S+)", flags=re.IGNORECASE)
+READ_CHUNK = 1000
+
+
+def _inspect(item):
+    """(filename, catalogue number as text, valid, comment, Image ID) for one scanned file."""
+    path, _st = item
+    catalogue_number, valid = validators.is_filename_cat_num(path.name)
+    if isinstance(catalogue_number, list):
+        catalogue_number = "+".join(catalogue_number)
+    comment = validators.read_image_id(path) or ""
+    m = IMAGE_ID_REGEX.search(comment)
+    return path.name, (catalogue_number or "").strip(), valid, comment, m.group(1).strip() if m else ""
+
+
+def scan_files(scan_root, workers=None):
+    """Inspect every file of scan_root once, sorted by filename."""
+    workers = workers or int(os.getenv("AUDIT_WORKERS", "8"))
+    files = []
+    items = scanner.scan(scan_root)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Chunks keep the number of pending reads bounded on very large directories
+        while chunk := list(islice(items, READ_CHUNK)):
+            files.extend(executor.map(_inspect, chunk))
+    files.sort()
+    log.info("Audit: %s files inspected in %s", len(files), scan_root)
+    return files
+
+
+def _write_csv(path, header, rows, what):
+    try:
+        with path.open("w", newline="", encoding="utf-8") as fh:
+            writer = csv.writer(fh)
+            if header:
+                writer.writerow(header)
+            writer.writerows(rows)
+        log.info("Wrote %s: %s", what, path)
+    except Exception:
+        log.exception("Failed to write %s: %s", what, path)
+
+
+def report_att_loc_exist(files, store, has_asset):
+    """
+    For each file with an Image ID in its comment, write a row with:
+    [attachment location, catalogue number, filename, found in DB csv, cat num equal, found in asset]
+    """
+    out_rows = []
+    for filename, file_cat, _valid, _comment, image_id in files:
+        if not image_id:
+            continue
+        # Image ID in column 3 (last match wins, header row skipped), catalogue number reference in column 1
+        row = refstore.first_by(store, "attachment_list", "c3", image_id, min_rownum=1, last=True)
+        if row is not None:
+            # Compare stems to ignore extensions if the CSV stores filenames
+            csv_cat_stem = Path(row["c1"]).stem if row["c1"] else ""
+            cat_num_equal = "yes" if (file_cat and csv_cat_stem == file_cat) else "no"
+        else:
+            cat_num_equal = "no"
+        found_in_asset = has_asset and refstore.contains(store, "asset_att_loc", "c0", image_id)
+        out_rows.append([
+            image_id,
+            file_cat,
+            filename,
+            "yes" if row is not None else "no",
+            cat_num_equal,
+            "yes" if found_in_asset else "no",
+        ])
+
+    out_header = ["attachment location", "catalogue number", "filename", "found in DB csv", "cat num equal", "found in asset"]
+    out_csv = ATTACHMENT_LIST_CSV.with_name(f"{ATTACHMENT_LIST_CSV.stem}_att_loc_exist.csv")
+    _write_csv(out_csv, out_header, out_rows, "summary CSV")
+
+
+def report_files_list(files, store, has_check):
+    """Every file with its Image ID, checked against attachment_list_updated.csv (att_loc column 0, catalogue number column 2)."""
+    out_rows = []
+    for filename, catalogue_number, valid, _comment, image_id in files:
+        csv_cat = ""
+        mapped_att = ""
+        if has_check and image_id:
+            row = refstore.first_by(store, "attachment_list_updated", "c0", image_id)
+            csv_cat = row["c2"] if row is not None else ""
+        if has_check and catalogue_number:
+            row = refstore.first_by(store, "attachment_list_updated", "c2", catalogue_number)
+            mapped_att = row["c0"] if row is not None else ""
+        match_in_check = bool(catalogue_number and csv_cat and csv_cat == catalogue_number)
+
+        mistakes = []
+        # Catalogue number exists in the CSV mapped to a different attachment location
+        if mapped_att and mapped_att != image_id:
+            mistakes.append(
+                f"catalogue number in filename {catalogue_number} maps to att_loc '{mapped_att}' in CSV (comment att_loc '{image_id}')"
+            )
+        # Attachment location exists in the CSV but for a different catalogue number
+        if csv_cat and csv_cat != catalogue_number:
+            mistakes.append(
+                f"attachment location in comment associated in CSV with catalogue number {csv_cat} (file catalogue {catalogue_number})"
+            )
+
+        out_rows.append([
+            filename,
+            catalogue_number,
+            "yes" if valid else "no",
+            image_id,
+            "yes" if match_in_check else "no",
+            "; ".join(mistakes),
+        ])
+
+    out_header = ["filename", "catalogue_number", "is_catalogue_number", "image_id", "match_in_check_csv", "found_with_mistake"]
+    _write_csv(FILES_LIST_CSV, out_header, out_rows, "files list CSV")
+
+
+def report_check_files(files, store, export=False):
+    """
+    Set the status (column 3) of the attachment_list.csv rows for the Image IDs found in the files
+    and write the ones that are not in it to attachment_list_missing.csv.
+    The statuses are kept in the reference store; export writes them back into attachment_list.csv.
+    """
+    statuses = []
+    missing: list[tuple[str, str]] = []
+    for _filename, file_cat, valid, comment, image_id in files:
+        if not valid or not comment:
+            continue
+        att_loc = image_id or comment.strip()
+        row = refstore.first_by(store, "attachment_list", "c0", att_loc)
+        if row is None:
+            missing.append((att_loc, file_cat))
+            continue
+        csv_cat_stem = Path(row["c2"]).stem if row["c2"] else ""
+        if file_cat and csv_cat_stem == file_cat:
+            statuses.append((row["rownum"], "att_loc exists, same catalogue numbers"))
+        else:
+            statuses.append((row["rownum"], f"att_loc exists, but for catalogue number {file_cat}"))
+
+    refstore.set_statuses(store, "attachment_list", statuses)
+    log.info("Updated the status of %s rows of %s", len(statuses), ATTACHMENT_LIST_CSV)
+    if export:
+        try:
+            refstore.export(store, "attachment_list", ATTACHMENT_LIST_CSV)
+            log.info("Wrote updated CSV: %s", ATTACHMENT_LIST_CSV)
+        except Exception:
+            log.exception("Failed to write updated CSV: %s", ATTACHMENT_LIST_CSV)
+    if missing:
+        missing_csv = ATTACHMENT_LIST_CSV.with_name(ATTACHMENT_LIST_CSV.stem + "_missing.csv")
+        _write_csv(missing_csv, ["attachment_location", "catalogue_number"], missing, "missing attachments")
+
+
+def run(reports=REPORTS, scan_root=None, workers=None, export=False):
+    """
+    Scan once and write the given reports (default all three). export also writes the
+    check_files statuses back into attachment_list.csv.
+    """
+    unknown = set(reports) - set(REPORTS)
+    if unknown:
+        raise ValueError(f"Unknown audit reports: {', '.join(sorted(unknown))}")
+    scan_root = scan_root or controller.scan_root()
+
+    # Bring the reference CSVs the reports need into the store (only changed files are read)
+    store = refstore.open_store()
+    try:
+        if "att_loc_exist" in reports or "check_files" in reports:
+            if not refstore.sync_source(store, "attachment_list", ATTACHMENT_LIST_CSV):
+                log.error("CSV file not found: %s", ATTACHMENT_LIST_CSV)
+                reports = [r for r in reports if r == "files_list"]
+        has_asset = "att_loc_exist" in reports and refstore.sync_source(store, "asset_att_loc", ASSET_ATT_LOC_CSV)
+        if "att_loc_exist" in reports and not has_asset:
+            log.warning("Asset CSV not found, 'found in asset' will be 'no': %s", ASSET_ATT_LOC_CSV)
+        has_check = "files_list" in reports and refstore.sync_source(store, "attachment_list_updated", ATTACHMENT_LIST_UPDATED_CSV)
+        if not reports:
+            return
+
+        files = scan_files(scan_root, workers)
+        if "att_loc_exist" in reports:
+            report_att_loc_exist(files, store, has_asset)
+        if "files_list" in reports:
+            report_files_list(files, store, has_check)
+        if "check_files" in reports:
+            report_check_files(files, store, export)
+    finally:
+        store.close()
@@ -1,110 +1,331 @@
 import os
-from logs.logging_setup import setup_run_logger
 import logging
 from pathlib import Path
-from dotenv import load_dotenv
 
 from api import client
+from api import journal
+from api import transport
 from sync import validators
 from sync import helpers
-import pandas as pd
+from sync import state
+from sync import metrics
+from sync import scanner
 
 
 import csv
 import re
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Set up logging
-logfile = setup_run_logger(level="DEBUG")
+# Logging is set up once per run by runlog.setup()
 log = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-ROOT = Path(__file__).resolve().parents[3]
-load_dotenv(ROOT / ".env")
+# Guards the split copy sets of the running sync_paths calls, filled from the worker threads
+_split_copies_lock = threading.Lock()
 
-SCAN_DIR = os.getenv("SCAN_DIR")
-if not SCAN_DIR:
-    log.error("Please set SCAN_DIR in your .env")
-    raise SystemExit(1)
 
-root = Path(SCAN_DIR)
-if not root.is_dir():
-    log.error("Folder not found: %s", root)
-    raise SystemExit(1)
+# SCAN_DIR from the environment (.env is loaded by the entry point), checked on every call
+# so a long running process picks up changes and nothing happens at import
+def scan_root():
+    scan_dir = os.getenv("SCAN_DIR")
+    if not scan_dir:
+        log.error("Please set SCAN_DIR in your .env")
+        raise SystemExit(1)
+    root = Path(scan_dir)
+    if not root.is_dir():
+        log.error("Folder not found: %s", root)
+        raise SystemExit(1)
+    return root
 
-recursive = False
-it = root.rglob("*") if recursive else root.glob("*")
+
+# Fresh iterator of (path, stat) over the scan directory for one run, see scanner.py
+# for recursion and include/exclude patterns
+def iter_scan(root):
+    return scanner.scan(root)
 
 def attach_file(path, catalogue_number, session):
+    with metrics.stage("attach_file"):
+        return _attach_file(path, catalogue_number, session)
+
+
+def _attach_file(path, catalogue_number, session):
     attached_location = client.attachment_to_col_object(path, catalogue_number, session)
 
     if attached_location:
-            log.info(f"Attachment process completed for file {path.name} to catalog number {catalogue_number}.")
+            log.info("Attachment process completed for file %s to catalog number %s.", path.name, catalogue_number)
+            metrics.incr("files_attached")
             # Write image id to file EXIF (comment field)
-            id_set = helpers.set_image_id(path, attached_location)
+            with metrics.stage("exif_write"):
+                id_set = helpers.set_image_id(path, attached_location)
             if id_set:
-                log.info(f"Image ID {attached_location} is set in EXIF for file {path.name}.")
+                log.info("Image ID %s is set in EXIF for file %s.", attached_location, path.name)
             else:
-                log.error(f"Failed to set Image ID in EXIF for file {path.name}.")
-            file_moved = helpers.move_to_uploaded_dir(path)
+                log.error("Failed to set Image ID in EXIF for file %s.", path.name)
+            with metrics.stage("move"):
+                file_moved = helpers.move_to_uploaded_dir(path)
             if file_moved:
-                log.info(f"File {path.name} moved to uploaded directory.")
+                log.info("File %s moved to uploaded directory.", path.name)
             else:
-                log.error(f"Failed to move file {path.name} to uploaded directory.")
+                log.error("Failed to move file %s to uploaded directory.", path.name)
     else:
-        log.error(f"Attachment process FAILED for file {path.name} to catalog number {catalogue_number}.")
+        log.error("Attachment process FAILED for file %s to catalog number %s.", path.name, catalogue_number)
+        metrics.incr("files_failed")
     return attached_location
 
-# Scanning files in directory, check in Specify and update if needed
-def sync_files():
-    # Scan directory for files
-    session = client.api_login()
+# Attach one scanned file to Specify (splitting multi catalogue number files first)
+# The outcome is stored in the state index (when given) against the file's stat at scan time
+# The split copies made are added to split_copies (when given) so the same run does not pick them up
+# Returns the number of successful attachments
+def process_file(path, count, session, index=None, st=None, split_copies=None):
+    log.info("\n\t\t\t\t***********************\nFILE (%s): %s", count, path.name)
+    catalogue_number, valid = validators.is_filename_cat_num(path.name)
+    image_id = validators.read_image_id(path)
+    log.info("File: %s, Catalogue number: %s, Valid: %s, Image id: %s", path.name, catalogue_number, valid, image_id)
+
+    def record(outcome):
+        if index is not None:
+            state.record(index, path, st, catalogue_number, valid, image_id, outcome)
+
+    if not valid or image_id is not None:
+        log.info("File %s skipped", path.name)
+        record("invalid" if not valid else "has_image_id")
+        return 0
+
+    if not (catalogue_number and isinstance(catalogue_number, list)):
+        attached = attach_file(path, catalogue_number, session)
+        record("attached" if attached else "failed")
+        return 1 if attached else 0
+
+    log.info("Multiple catalogue numbers found in filename %s: %s", path.name, catalogue_number)
+    if os.getenv("SPLIT_SHARED_ASSET") == "1":
+        return _attach_shared(path, catalogue_number, session, record)
+
+    count_attach = 0
+    if split_copies is not None:
+        with _split_copies_lock:
+            split_copies.update(path.parent / name for name in helpers.split_names(path))
+    with metrics.stage("split"):
+        splitted = helpers.split_image_multiple_cat_nums(path)
+    if not splitted:
+        log.error("Failed to split file %s to multiple catalogue numbers.", path.name)
+        record("split_failed")
+        return 0
+
+    log.info("File %s split into %s files to individual catalogue numbers.", path.name, len(splitted))
+    # The split copies of one original are attached in order, within the same worker
+    uploaded_all_files = True
+    for idx, cat_num in enumerate(catalogue_number):
+        new_path = path.parent / splitted[idx]
+        if attach_file(new_path, cat_num, session):
+            count_attach += 1
+        else:
+            uploaded_all_files = False
+    if uploaded_all_files:
+        log.info("All split files from %s uploaded successfully.", path.name)
+        moved = helpers.move_to_uploaded_dir(path)
+        if moved:
+            log.info("Original file %s moved to uploaded directory after splitting.", path.name)
+        else:
+            log.error("Failed to move original file %s to uploaded directory after splitting.", path.name)
+    record("attached" if uploaded_all_files else "failed")
+    return count_attach
+
+
+# Upload a multi catalogue number file once and attach it to all its collection objects
+# (SPLIT_SHARED_ASSET=1), instead of splitting it into one copy per catalogue number
+# Returns the number of successful attachments
+def _attach_shared(path, catalogue_number, session, record):
+    targets = list(zip(catalogue_number, helpers.split_names(path)))
+    results = client.attachment_to_col_objects(path, targets, session)
+    attached = [loc for loc in results.values() if loc]
+    if len(attached) < len(targets):
+        # Left in place without an Image ID, so the next run attaches it again (same-name attachments are replaced)
+        log.error("Attachment process FAILED for file %s to catalog numbers %s.", path.name, [c for c, loc in results.items() if not loc])
+        record("failed")
+        return len(attached)
+
+    log.info("File %s attached to all catalogue numbers %s.", path.name, catalogue_number)
+    with metrics.stage("exif_write"):
+        id_set = helpers.set_image_id(path, attached[0])
+    if id_set:
+        log.info("Image ID %s is set in EXIF for file %s.", attached[0], path.name)
+    else:
+        log.error("Failed to set Image ID in EXIF for file %s.", path.name)
+    with metrics.stage("move"):
+        file_moved = helpers.move_to_uploaded_dir(path)
+    if file_moved:
+        log.info("File %s moved to uploaded directory.", path.name)
+    else:
+        log.error("Failed to move file %s to uploaded directory.", path.name)
+    record("attached")
+    return len(attached)
+
+
+# Stat a scanned path, returns None if it is not a regular file
+def _scan_stat(path):
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+
+# Filenames that will be uploaded for path and their catalogue numbers, used to prefetch per window
+def _upload_targets(path):
+    catalogue_number, valid = validators.is_filename_cat_num(path.name)
+    if not valid:
+        return [], []
+    if isinstance(catalogue_number, list):
+        if os.getenv("SPLIT_SHARED_ASSET") == "1":
+            return [path.name], catalogue_number
+        return helpers.split_names(path), catalogue_number
+    return [path.name], [catalogue_number]
+
+
+# Collect finished futures, returns the number of attachments they made
+# HostUnavailable from any of them is raised again once all are collected, it stops the run
+def _collect_done(done, pending):
+    count_attach = 0
+    outage = None
+    for future in done:
+        path = pending.pop(future)
+        try:
+            count_attach += future.result()
+        except transport.HostUnavailable as e:
+            outage = e
+        except Exception:
+            log.exception("Unexpected error while syncing file %s", path.name)
+    if outage is not None:
+        raise outage
+    return count_attach
+
+
+# Prefetch upload params and collection objects for a window of files, a few bulk requests
+# instead of one of each per file
+def _prefetch_window(session, window):
+    filenames = []
+    cat_nums = []
+    for path, _, _ in window:
+        names, nums = _upload_targets(path)
+        filenames.extend(names)
+        cat_nums.extend(nums)
+    if filenames:
+        client.prefetch_upload_params(session, filenames)
+        client.resolve_col_objects(session, cat_nums)
+
+
+# Prefetch for a window of files, then queue them for the workers
+# Returns the number of attachments made by tasks that finished meanwhile
+def _submit_window(executor, window, pending, session, workers, index, split_copies):
+    count_attach = 0
+    _prefetch_window(session, window)
+    for path, count, st in window:
+        pending[executor.submit(process_file, path, count, session, index, st, split_copies)] = path
+        # Keep the queue bounded so huge directories are not listed into memory up front
+        if len(pending) >= workers * 2:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            count_attach += _collect_done(done, pending)
+    return count_attach
+
+
+# Sync the given paths (or (path, stat) pairs from the scanner) to Specify, skipping files the
+# state index knows are unchanged
+# workers > 1 runs attach_file for several files at once (SYNC_WORKERS in .env, default 1)
+# Raises transport.HostUnavailable when Specify stays unreachable, the files not synced yet are
+# left untouched (in both modes) so the next run picks them up
+# Returns (files processed, attachments made, unchanged files skipped)
+def sync_paths(paths, session, index, workers=None):
+    if workers is None:
+        workers = int(os.getenv("SYNC_WORKERS", "1"))
     count = 0
     count_attach = 0
+    count_unchanged = 0
+    # Collection objects are resolved again for every call, their versions change between runs
+    client.clear_col_obj_cache()
+    # Split copies created by this call; the scanner streams directories while files are being
+    # split into them, and a copy it picks up must not be attached a second time
+    split_copies = set()
 
-    stopped_by_limit = False
-    for path in it:
-        if path.is_file():
-            count += 1
-            log.info(f"\n\t\t\t\t***********************\nFILE ({count}): {path.name}")
-            catalogue_number, valid = validators.is_filename_cat_num(path.name)
-            image_id = validators.read_image_id(path)
-            log.info(f"File: {path.name}, Catalogue number: {catalogue_number}, Valid: {valid}, Image id: {image_id}")
-            
-            if not valid or image_id is not None:
-                log.info(f"File {path.name} skipped")
+    def scanned_files():
+        nonlocal count_unchanged
+        for item in paths:
+            # Scanner results come with their stat, plain paths (e.g. from the watcher) are stat'ed here
+            path, st = item if isinstance(item, tuple) else (item, _scan_stat(item))
+            if st is None:
                 continue
-
-            if catalogue_number and isinstance(catalogue_number, list):
-                uploaded_all_files = False
-                log.info(f"Multiple catalogue numbers found in filename: {catalogue_number}")
-                splitted = helpers.split_image_multiple_cat_nums(path)
-                if splitted:
-                    log.info(f"File {path.name} split into {len(splitted)} files to individual catalogue numbers.")
-                    for idx, cat_num in enumerate(catalogue_number):
-                        new_path = root / splitted[idx]
-                        attached = attach_file(new_path, cat_num, session)
-                        if attached and idx == 0:
-                            count_attach += 1
-                            uploaded_all_files = True
-                        elif attached and idx > 0 and uploaded_all_files is False:
-                            count_attach += 1
-                            uploaded_all_files = False
-                        elif attached and uploaded_all_files:
-                            count_attach += 1
-                        elif not attached:
-                            uploaded_all_files = False
-                    if uploaded_all_files:
-                        log.info(f"All split files from {path.name} uploaded successfully.")
-                        moved = helpers.move_to_uploaded_dir(path)
-                        if moved:
-                            log.info(f"Original file {path.name} moved to uploaded directory after splitting.")
-                        else:
-                            log.error(f"Failed to move original file {path.name} to uploaded directory after splitting.")
-                else:
-                    log.error(f"Failed to split file {path.name} to multiple catalogue numbers.")
+            with _split_copies_lock:
+                if path in split_copies:
+                    continue
+            if state.is_unchanged_skip(index, path, st):
+                count_unchanged += 1
                 continue
-           
-            else:
-                attach_file(path, catalogue_number, session)
+            yield path, st
+
+    # Files are handled in windows of UPLOAD_PARAMS_BATCH (default 100), whose upload params and
+    # collection objects are fetched in bulk up front, in both modes
+    batch_size = int(os.getenv("UPLOAD_PARAMS_BATCH", "100"))
+
+    def windows():
+        nonlocal count
+        window = []
+        for path, st in scanned_files():
+            count += 1
+            window.append((path, count, st))
+            if len(window) >= batch_size:
+                yield window
+                window = []
+        if window:
+            yield window
 
-    log.info(f"Scan completed. Iterated {count} files under {root}")
\ No newline at end of file
+    try:
+        if workers <= 1:
+            for window in windows():
+                _prefetch_window(session, window)
+                for path, file_count, st in window:
+                    try:
+                        count_attach += process_file(path, file_count, session, index, st, split_copies)
+                    except transport.HostUnavailable:
+                        raise
+                    except Exception:
+                        log.exception("Unexpected error while syncing file %s", path.name)
+        else:
+            log.info("Syncing with %s workers", workers)
+            pending = {}
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                try:
+                    for window in windows():
+                        count_attach += _submit_window(executor, window, pending, session, workers, index, split_copies)
+                    done, _ = wait(list(pending))
+                    count_attach += _collect_done(done, pending)
+                except transport.HostUnavailable:
+                    # Queued files are not started, the running ones finish before the executor closes
+                    for future in pending:
+                        future.cancel()
+                    raise
+    finally:
+        # Entries of this batch are on disk before it returns, whatever the buffer size
+        journal.flush()
+
+    return count, count_attach, count_unchanged
+
+
+# Scanning files in directory, check in Specify and update if needed
+# Per-stage timings are exported at the end (METRICS_TEXTFILE / METRICS_SUMMARY in .env)
+def sync_files(workers=None):
+    metrics.reset()
+    # Scan directory for files
+    with metrics.stage("login"):
+        session = client.api_login()
+    root = scan_root()
+    index = state.open_index()
+    try:
+        count, count_attach, count_unchanged = sync_paths(iter_scan(root), session, index, workers)
+        log.info("Scan completed. Iterated %s files under %s (%s unchanged files skipped), %s attachments made.", count, root, count_unchanged, count_attach)
+    except transport.HostUnavailable as e:
+        log.error(" !!!! Sync stopped, the remaining files are left for the next run: %s", e)
+    finally:
+        index.close()
+        run_summary = metrics.export()
+        for name, stage_summary in run_summary["stages"].items():
+            log.info("Stage %s: %s", name, stage_summary)
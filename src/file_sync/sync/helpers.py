@@ -1,25 +1,73 @@
 from pathlib import Path
 from PIL import Image
 import piexif
-import pandas as pd
 import os
-from logs.logging_setup import setup_run_logger
+import shutil
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 import logging
 
-from api import client
-from sync import validators
 
 
-# Set up logging
-logfile = setup_run_logger(level="DEBUG")
+# Logging is set up once per run by runlog.setup()
 log = logging.getLogger(__name__)
 
 XP_COMMENT_TAG = 0x9C9C
+FICLONE = 0x40049409  # Linux ioctl that reflinks a whole file (btrfs, XFS, ...)
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _image_id_comment(attachment_location: str) -> bytes:
+    """UserComment value for the Image ID, with the 8 bytes character code prefix."""
+    if attachment_location is None:
+        comment_str = ""
+    else:
+        comment_str = f"ImageID: {attachment_location}"
+    return b'ASCII\x00\x00\x00' + comment_str.encode('ascii')
 
 
 def set_image_id(image_path: Path, attachment_location: str) -> bool:
-    """Write attachment location as Image ID in image metadata."""
+    """
+    Write attachment location as Image ID in image metadata.
+    JPEG files get a metadata-only rewrite (pixel data is not touched), written to a temp file
+    that atomically replaces the original. Other formats fall back to re-saving with Pillow.
+    """
+    if image_path.suffix.lower() not in (".jpg", ".jpeg"):
+        return _set_image_id_reencode(image_path, attachment_location)
+
+    tmp = image_path.with_suffix(image_path.suffix + ".tmp_exif")
+    try:
+        # Read bytes once for lossless update
+        with image_path.open("rb") as f:
+            data = f.read()
+
+        # Load existing EXIF, or initialize a valid empty structure
+        try:
+            exif_dict = piexif.load(data)
+        except Exception:
+            exif_dict = {"0th":{}, "Exif":{}, "GPS":{}, "1st":{}, "Interop":{}, "thumbnail": None}
+        exif_dict.setdefault("Exif", {})
+        exif_dict["Exif"][piexif.ExifIFD.UserComment] = _image_id_comment(attachment_location)
+
+        piexif.insert(piexif.dump(exif_dict), data, str(tmp))
+        os.replace(tmp, image_path)
+        return True
+
+    except Exception as e:
+        log.error("Error setting Image ID for %s: %s", image_path.name, str(e))
+        tmp.unlink(missing_ok=True)
+        return False
+
+
+def _set_image_id_reencode(image_path: Path, attachment_location: str) -> bool:
+    """
+    Write the Image ID by decoding and re-saving the image, for formats piexif cannot insert into.
+    The image is saved to a temp file that replaces the original, never written into it.
+    """
     img = None  # Initialize img to None
+    tmp = image_path.with_suffix(image_path.suffix + ".tmp_exif")
     try:
         # Open the image
         img = Image.open(image_path)
@@ -35,30 +83,22 @@ def set_image_id(image_path: Path, attachment_location: str) -> bool:
         if 'Exif' not in exif_dict:
             exif_dict['Exif'] = {}
 
-        # Create UserComment tag with the ID for better visibility in some viewers
-        # Manually construct the UserComment tag for compatibility with older piexif versions
-        if attachment_location is None:
-            comment_str = ""
-        else:
-            comment_str = f"ImageID: {attachment_location}"
-        # The UserComment tag requires a character code prefix (8 bytes)
-        user_comment = b'ASCII\x00\x00\x00' + comment_str.encode('ascii')
-        exif_dict['Exif'][piexif.ExifIFD.UserComment] = user_comment
+        exif_dict['Exif'][piexif.ExifIFD.UserComment] = _image_id_comment(attachment_location)
 
         # Convert to bytes and save
         exif_bytes = piexif.dump(exif_dict)
 
         # Save with new metadata, preserving quality
-        img.save(image_path, exif=exif_bytes, quality=100)
-        #TODO: Make sure that image quality is preserved. Check if the file size might by smaller
-        #print(f"Added Image ID {attachment_location} to {image_path.name}")
+        img.save(tmp, format=img.format, exif=exif_bytes, quality=100)
         img.close()
+        os.replace(tmp, image_path)
         return True
 
     except Exception as e:
-        #log.error(f"Error setting Image ID for {image_path.name}: {str(e)}")
+        #log.error("Error setting Image ID for %s: %s", image_path.name, str(e))
         if img:
             img.close()
+        tmp.unlink(missing_ok=True)
         return False
     
 
@@ -101,21 +141,100 @@ def clear_comment_field(filename) -> bool:
     with Image.open(image_path) as img:
         img.save(image_path, exif=exif_bytes)
 
-def move_to_uploaded_dir(filepath):
+# Where move_to_uploaded_dir puts filepath: files from subdirectories of the scan root
+# (SCAN_RECURSIVE=1) keep their relative path under UPLOADED_DIR, so files with the same name
+# in different directories do not collide
+def uploaded_path(filepath, scan_root=None) -> Path:
+    scan_root = Path(scan_root or os.getenv("SCAN_DIR") or filepath.parent)
+    try:
+        relative = filepath.relative_to(scan_root)
+    except ValueError:
+        relative = Path(filepath.name)
+    return Path(os.getenv("UPLOADED_DIR")) / relative
+
+
+# An existing file in UPLOADED_DIR is never overwritten, the move fails instead
+def move_to_uploaded_dir(filepath, scan_root=None):
     uploaded_dir = Path(os.getenv("UPLOADED_DIR"))
     if not uploaded_dir.exists():
-        log.error(f"Uploaded directory does not exist")
+        log.error("Uploaded directory does not exist")
         return False
 
     # Move the file
     try:
-        new_path = uploaded_dir / filepath.name
+        new_path = uploaded_path(filepath, scan_root)
+        relative = new_path.relative_to(uploaded_dir)
+        if new_path.exists():
+            log.error("Not moving file %s, %s already exists in the uploaded directory", filepath.name, relative)
+            return False
+        new_path.parent.mkdir(parents=True, exist_ok=True)
         filepath.rename(new_path)
         return True
     except Exception as e:
-        log.error(f"Error moving file {filepath.name}: {str(e)}")
+        log.error("Error moving file %s: %s", filepath.name, str(e))
         return False
     
+def _kernel_copy(copy_fn, src_fd, dst_fd, size):
+    offset = 0
+    while offset < size:
+        copied = copy_fn(src_fd, dst_fd, offset, size - offset)
+        if copied == 0:
+            raise OSError("Source file ended early")
+        offset += copied
+
+
+def copy_file(src: Path, dst: Path) -> str:
+    """
+    Copy src to dst as cheaply as the filesystem allows, without reading the file into memory:
+    hardlink (only JPEGs, with SPLIT_HARDLINK=1), reflink, os.copy_file_range, os.sendfile,
+    then streaming in chunks. Returns the method that was used.
+    Hardlinked copies share their data, which is safe as long as they are only changed
+    through set_image_id/clear_comment_field on JPEGs (both replace the file instead of writing into it).
+    """
+    if os.getenv("SPLIT_HARDLINK") == "1" and src.suffix.lower() in (".jpg", ".jpeg"):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflink"
+            except OSError:
+                pass
+
+        size = os.fstat(fsrc.fileno()).st_size
+        kernel_copies = []
+        if hasattr(os, "copy_file_range"):
+            kernel_copies.append(("copy_file_range",
+                lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count, offset, offset)))
+        if hasattr(os, "sendfile"):
+            # sendfile writes at the current position of dst, which starts at 0
+            kernel_copies.append(("sendfile",
+                lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count)))
+        for method, copy_fn in kernel_copies:
+            try:
+                _kernel_copy(copy_fn, fsrc.fileno(), fdst.fileno(), size)
+                return method
+            except OSError:
+                # Not supported for these files (e.g. across filesystems), start over with the next method
+                fdst.seek(0)
+                fdst.truncate()
+
+        fsrc.seek(0)
+        fdst.seek(0)
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+        return "stream"
+
+
+def split_names(image_path: Path) -> list[str]:
+    """Filenames of the copies split_image_multiple_cat_nums creates for image_path."""
+    return [f"{base}{image_path.suffix}" for base in image_path.stem.split('+')]
+
+
 def split_image_multiple_cat_nums(image_path: Path) -> bool:
     """
     Split an image file into multiple copies based on catalogue numbers in the filename.
@@ -123,18 +242,15 @@ def split_image_multiple_cat_nums(image_path: Path) -> bool:
     """
     names = []
     try:
-        stem = image_path.stem
-        names = stem.split('+')
-        for i, base in enumerate(names):
-            names[i] = f"{base}{image_path.suffix}"
-            new_path = image_path.parent / names[i]
+        names = split_names(image_path)
+        for name in names:
+            new_path = image_path.parent / name
             # Copy the original file to the new filename
-            with image_path.open("rb") as src_file:
-                with new_path.open("wb") as dst_file:
-                    dst_file.write(src_file.read())
+            method = copy_file(image_path, new_path)
+            log.debug("Copied %s to %s (%s)", image_path.name, name, method)
 
     except Exception as e:
-        log.error(f"Error splitting image {image_path.name}: {str(e)}")
+        log.error("Error splitting image %s: %s", image_path.name, str(e))
         return None
     
     return names
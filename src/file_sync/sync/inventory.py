@@ -0,0 +1,278 @@
+import csv
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from api import client
+from api import transport
+from sync import audit
+from sync import controller
+from sync import helpers
+from sync import validators
+
+
+# Local mirror of the collection's collection objects and their attachments in Specify, so the
+# state of the server is known from one bulk download instead of one request per catalogue number.
+# refresh() pages through /api/specify/collectionobject/ INVENTORY_PAGE (default 1000) records at a
+# time; later refreshes only ask for the records modified since the last one (timestampmodified,
+# which Specify bumps on every save, attachments included). A full refresh also drops the
+# collection objects deleted on the server.
+# diff() compares the mirror with SCAN_DIR and reports:
+#   missing      a file whose catalogue number has no attachment with its filename
+#   orphaned     a file whose Image ID is not attached to any collection object
+#   duplicate    a collection object with the same filename attached more than once
+#   no_col_obj   a file whose catalogue number has no collection object in the collection
+# Location is INVENTORY_DB in .env, default inventory.sqlite3 next to the .env file.
+ROOT = Path(__file__).resolve().parents[3]
+
+log = logging.getLogger(__name__)
+
+ISSUES = ("missing", "orphaned", "duplicate", "no_col_obj")
+
+
+def open_inventory(db_path=None) -> sqlite3.Connection:
+    """Open (and create if needed) the inventory mirror."""
+    db_path = db_path or os.getenv("INVENTORY_DB") or ROOT / "inventory.sqlite3"
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS col_objs (
+            id INTEGER PRIMARY KEY,
+            catalognumber TEXT,
+            version INTEGER,
+            timestampmodified TEXT,
+            refreshed INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS col_objs_catalognumber ON col_objs (catalognumber);
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY,
+            col_obj_id INTEGER NOT NULL,
+            attachmentlocation TEXT,
+            origfilename TEXT,
+            filename_key TEXT
+        );
+        CREATE INDEX IF NOT EXISTS attachments_col_obj ON attachments (col_obj_id, filename_key);
+        CREATE INDEX IF NOT EXISTS attachments_location ON attachments (attachmentlocation);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """
+    )
+    conn.commit()
+    return conn
+
+
+def _meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def _store_page(conn, objects, refresh_id):
+    for col_obj in objects:
+        conn.execute(
+            "INSERT OR REPLACE INTO col_objs (id, catalognumber, version, timestampmodified, refreshed) VALUES (?, ?, ?, ?, ?)",
+            (col_obj["id"], col_obj["catalognumber"], col_obj["version"], col_obj.get("timestampmodified"), refresh_id),
+        )
+        # The attachments come inline, replace the stored list as a whole
+        conn.execute("DELETE FROM attachments WHERE col_obj_id = ?", (col_obj["id"],))
+        conn.executemany(
+            "INSERT OR REPLACE INTO attachments (id, col_obj_id, attachmentlocation, origfilename, filename_key) VALUES (?, ?, ?, ?, ?)",
+            [
+                (att["id"], col_obj["id"], att["attachment"]["attachmentlocation"], att["attachment"]["origfilename"],
+                 (att["attachment"]["origfilename"] or "").casefold())
+                for att in col_obj.get("collectionobjectattachments") or ()
+            ],
+        )
+
+
+def refresh(conn, session, full=False):
+    """
+    Download the collection objects modified since the last refresh (all of them if full or on
+    the first run) into the mirror. Returns the number of records downloaded, or None on failure.
+    """
+    page_size = int(os.getenv("INVENTORY_PAGE", "1000"))
+    url_colobj = os.getenv("API_DOMAIN") + "/api/specify/collectionobject/"
+    since = None if full else _meta(conn, "last_modified")
+    full = since is None
+    refresh_id = time.time_ns()
+
+    params = {
+        "collection": int(os.getenv("API_COLLECTIONID")),
+        "orderby": "timestampmodified",
+        "limit": page_size,
+        "offset": 0,
+    }
+    if since:
+        # Records saved in the same second as the last one seen come again, the upsert absorbs them
+        params["timestampmodified__gte"] = since
+    log.info("Refreshing the inventory %s...", f"since {since}" if since else "(full)")
+
+    count = 0
+    last_modified = since
+    while True:
+        response = transport.request(session, "GET", url_colobj, params=params)
+        if response.status_code != 200:
+            log.error(" !!!! Failed to download collection objects with status code %s.", response.status_code)
+            conn.commit()
+            return None
+        response_json = response.json()
+        objects = response_json["objects"]
+        _store_page(conn, objects, refresh_id)
+        conn.commit()
+        count += len(objects)
+        for col_obj in objects:
+            stamp = col_obj.get("timestampmodified")
+            if stamp and (last_modified is None or stamp > last_modified):
+                last_modified = stamp
+        params["offset"] += len(objects)
+        log.info("Inventory: %s / %s collection objects downloaded.", params["offset"], response_json["meta"]["total_count"])
+        if not objects or params["offset"] >= response_json["meta"]["total_count"]:
+            break
+
+    if full:
+        # Not seen in a full download: deleted on the server
+        conn.execute("DELETE FROM attachments WHERE col_obj_id IN (SELECT id FROM col_objs WHERE refreshed != ?)", (refresh_id,))
+        conn.execute("DELETE FROM col_objs WHERE refreshed != ?", (refresh_id,))
+    if last_modified:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_modified', ?)", (last_modified,))
+    conn.commit()
+    log.info("Inventory refreshed: %s collection objects downloaded.", count)
+    return count
+
+
+def has_col_obj(conn, cat_num) -> bool:
+    return conn.execute("SELECT 1 FROM col_objs WHERE catalognumber = ?", (cat_num,)).fetchone() is not None
+
+
+def is_attached(conn, cat_num, filename) -> bool:
+    """True if the collection object of cat_num has an attachment named filename (case-insensitive)."""
+    return conn.execute(
+        "SELECT 1 FROM attachments a JOIN col_objs c ON c.id = a.col_obj_id WHERE c.catalognumber = ? AND a.filename_key = ?",
+        (cat_num, filename.casefold()),
+    ).fetchone() is not None
+
+
+def location_attached(conn, attachment_location) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM attachments WHERE attachmentlocation = ?", (attachment_location,)
+    ).fetchone() is not None
+
+
+def is_empty(conn) -> bool:
+    return conn.execute("SELECT 1 FROM col_objs LIMIT 1").fetchone() is None
+
+
+def expected_attachments(filename):
+    """(catalogue number, attachment filename) pairs a scanned file should end up as in Specify."""
+    catalogue_number, valid = validators.is_filename_cat_num(filename)
+    if not valid:
+        return []
+    if isinstance(catalogue_number, list):
+        # Split copies and shared assets are both attached under the split names
+        return list(zip(catalogue_number, helpers.split_names(Path(filename))))
+    return [(catalogue_number, filename)]
+
+
+def diff(conn, scan_root=None, workers=None):
+    """
+    Compare SCAN_DIR with the mirror. Returns a list of
+    (issue, catalogue number, filename, attachment location, detail) rows.
+    """
+    files = audit.scan_files(scan_root or controller.scan_root(), workers)
+
+    # The scan goes into temporary tables, the comparisons are joins
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS temp.scan_targets;
+        DROP TABLE IF EXISTS temp.scan_ids;
+        CREATE TEMP TABLE scan_targets (catalognumber TEXT, filename TEXT, filename_key TEXT);
+        CREATE TEMP TABLE scan_ids (filename TEXT, catalognumber TEXT, attachmentlocation TEXT);
+        """
+    )
+    conn.executemany(
+        "INSERT INTO temp.scan_targets VALUES (?, ?, ?)",
+        [(cat_num, name, name.casefold())
+         for filename, _cat, _valid, _comment, _image_id in files
+         for cat_num, name in expected_attachments(filename)],
+    )
+    conn.executemany(
+        "INSERT INTO temp.scan_ids VALUES (?, ?, ?)",
+        [(filename, cat, image_id) for filename, cat, _valid, _comment, image_id in files if image_id],
+    )
+
+    rows = []
+    for r in conn.execute(
+        """
+        SELECT s.catalognumber, s.filename FROM temp.scan_targets s
+        WHERE NOT EXISTS (SELECT 1 FROM col_objs c WHERE c.catalognumber = s.catalognumber)
+        ORDER BY s.filename
+        """
+    ):
+        rows.append(("no_col_obj", r["catalognumber"], r["filename"], "", "catalogue number not in the collection"))
+    for r in conn.execute(
+        """
+        SELECT s.catalognumber, s.filename FROM temp.scan_targets s
+        JOIN col_objs c ON c.catalognumber = s.catalognumber
+        WHERE NOT EXISTS (SELECT 1 FROM attachments a WHERE a.col_obj_id = c.id AND a.filename_key = s.filename_key)
+        ORDER BY s.filename
+        """
+    ):
+        rows.append(("missing", r["catalognumber"], r["filename"], "", "not attached"))
+    for r in conn.execute(
+        """
+        SELECT i.catalognumber, i.filename, i.attachmentlocation FROM temp.scan_ids i
+        WHERE NOT EXISTS (SELECT 1 FROM attachments a WHERE a.attachmentlocation = i.attachmentlocation)
+        ORDER BY i.filename
+        """
+    ):
+        rows.append(("orphaned", r["catalognumber"], r["filename"], r["attachmentlocation"], "Image ID not attached in Specify"))
+    for r in conn.execute(
+        """
+        SELECT c.catalognumber, MIN(a.origfilename) AS origfilename, COUNT(*) AS n,
+               GROUP_CONCAT(a.attachmentlocation, ' ') AS locations
+        FROM attachments a JOIN col_objs c ON c.id = a.col_obj_id
+        GROUP BY a.col_obj_id, a.filename_key HAVING COUNT(*) > 1
+        ORDER BY c.catalognumber
+        """
+    ):
+        rows.append(("duplicate", r["catalognumber"], r["origfilename"], r["locations"], f"attached {r['n']} times"))
+
+    conn.executescript("DROP TABLE temp.scan_targets; DROP TABLE temp.scan_ids;")
+    return rows
+
+
+def write_report(rows, report_csv: Path):
+    try:
+        with report_csv.open("w", newline="", encoding="utf-8") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["issue", "catalogue_number", "filename", "attachment_location", "detail"])
+            writer.writerows(rows)
+        log.info("Wrote inventory diff: %s", report_csv)
+    except Exception:
+        log.exception("Failed to write inventory diff: %s", report_csv)
+
+
+# Refresh the mirror (unless no_refresh) and write the diff against SCAN_DIR to report_csv
+# (default inventory_diff.csv next to the .env file)
+def reconcile(report_csv=None, full=False, no_refresh=False):
+    conn = open_inventory()
+    try:
+        if not no_refresh:
+            session = client.api_login()
+            if session is None:
+                log.error("Login failed, inventory not refreshed.")
+                return
+            if refresh(conn, session, full) is None:
+                return
+        rows = diff(conn)
+        counts = {issue: sum(1 for r in rows if r[0] == issue) for issue in ISSUES}
+        log.info("Inventory diff: %s", ", ".join(f"{n} {issue}" for issue, n in counts.items()))
+        write_report(rows, Path(report_csv) if report_csv else ROOT / "inventory_diff.csv")
+        return counts
+    finally:
+        conn.close()
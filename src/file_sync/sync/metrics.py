@@ -0,0 +1,130 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Per-stage latency histograms and counters for the attach pipeline.
+# export() writes them as a Prometheus textfile (METRICS_TEXTFILE, for node_exporter's textfile
+# collector) and as an end-of-run JSON summary (METRICS_SUMMARY), when those are set in .env.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_started = time.time()
+
+
+def observe(stage_name, seconds):
+    """Record one duration for a stage."""
+    with _lock:
+        hist = _histograms.get(stage_name)
+        if hist is None:
+            hist = _histograms[stage_name] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+                break
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+
+@contextmanager
+def stage(stage_name):
+    """Time the enclosed block as one observation of stage_name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage_name, time.perf_counter() - start)
+
+
+def incr(counter_name, amount=1):
+    with _lock:
+        _counters[counter_name] = _counters.get(counter_name, 0) + amount
+
+
+def reset():
+    global _started
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _started = time.time()
+
+
+def _quantile(hist, q):
+    """Estimate a quantile from the histogram buckets (linear inside the bucket, like histogram_quantile)."""
+    if not hist["count"]:
+        return 0.0
+    rank = q * hist["count"]
+    seen = 0
+    lower = 0.0
+    for bound, n in zip(BUCKETS, hist["buckets"]):
+        if seen + n >= rank and n:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - seen) / n
+        seen += n
+        if not math.isinf(bound):
+            lower = bound
+    return lower
+
+
+def summary() -> dict:
+    with _lock:
+        elapsed = time.time() - _started
+        stages = {
+            name: {
+                "count": hist["count"],
+                "total_s": round(hist["sum"], 3),
+                "mean_s": round(hist["sum"] / hist["count"], 4) if hist["count"] else 0.0,
+                "p50_s": round(_quantile(hist, 0.5), 4),
+                "p99_s": round(_quantile(hist, 0.99), 4),
+            }
+            for name, hist in sorted(_histograms.items())
+        }
+        return {"elapsed_s": round(elapsed, 3), "stages": stages, "counters": dict(sorted(_counters.items()))}
+
+
+def prometheus_text() -> str:
+    lines = [
+        "# HELP file_sync_stage_seconds Duration of attach pipeline stages.",
+        "# TYPE file_sync_stage_seconds histogram",
+    ]
+    with _lock:
+        for name, hist in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, hist["buckets"]):
+                cumulative += n
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f'file_sync_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'file_sync_stage_seconds_sum{{stage="{name}"}} {hist["sum"]}')
+            lines.append(f'file_sync_stage_seconds_count{{stage="{name}"}} {hist["count"]}')
+        lines.append("# HELP file_sync_events_total Attach pipeline counters.")
+        lines.append("# TYPE file_sync_events_total counter")
+        for name, value in sorted(_counters.items()):
+            lines.append(f'file_sync_events_total{{event="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path: Path, text):
+    # The textfile collector may read at any time, so never expose a half written file
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def export():
+    """Write the Prometheus textfile and/or the JSON summary, returns the summary."""
+    result = summary()
+    textfile = os.getenv("METRICS_TEXTFILE")
+    if textfile:
+        _write_atomic(Path(textfile), prometheus_text())
+    summary_file = os.getenv("METRICS_SUMMARY")
+    if summary_file:
+        _write_atomic(Path(summary_file), json.dumps(result, indent=2))
+    return result
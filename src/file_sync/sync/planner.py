@@ -0,0 +1,323 @@
+import csv
+import logging
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from api import client
+from api import transport
+from sync import audit
+from sync import controller
+from sync import helpers
+from sync import inventory
+from sync import metrics
+from sync import scanner
+from sync import state
+from sync import validators
+
+
+# Plan mode: decide what a sync of SCAN_DIR would do before doing any of it.
+# build() scans SCAN_DIR and classifies every file against the state index and the inventory mirror
+# (inventory.py, no request per file):
+#   move     Image ID already attached in Specify, the file goes to UPLOADED_DIR
+#   replace  an attachment with the same filename exists and is replaced
+#   upload   a new attachment
+#   split    a multi catalogue number file, attached to each collection object
+#   skip     nothing to do (invalid name, no collection object, Image ID not attached, ...)
+# The plan is stored in PLAN_DB (default sync_plan.sqlite3 next to the .env file) with its expected
+# bytes and requests. execute() runs the pending actions in plan order, PLAN_BATCH (default 100) at a
+# time, and records every outcome, so an interrupted run resumes where it stopped.
+ROOT = Path(__file__).resolve().parents[3]
+
+log = logging.getLogger(__name__)
+
+# Execution order of the actions
+ACTIONS = ("move", "replace", "upload", "split", "skip")
+READ_CHUNK = 1000
+
+
+def open_plan(db_path=None) -> sqlite3.Connection:
+    """Open (and create if needed) the plan store."""
+    db_path = db_path or os.getenv("PLAN_DB") or ROOT / "sync_plan.sqlite3"
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS plan (
+            seq INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            action TEXT NOT NULL,
+            cat_nums TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            bytes INTEGER,
+            requests INTEGER,
+            reason TEXT,
+            status TEXT NOT NULL,
+            updated REAL
+        )
+        """
+    )
+    conn.commit()
+    return conn
+
+
+def _read_comment(item):
+    """Image ID comment of a scanned file, taken from the state index when it is unchanged since the last run."""
+    path, st, known = item
+    if known is not None and known["outcome"] in state.SKIP_OUTCOMES:
+        return known["image_id"]
+    return validators.read_image_id(path)
+
+
+def _classify(path, st, comment, inv):
+    """(path, stat, action, catalogue numbers, bytes, requests, reason) for one scanned file."""
+    catalogue_number, valid = validators.is_filename_cat_num(path.name)
+    if not valid:
+        return path, st, "skip", "", 0, 0, "invalid filename"
+    cat_nums = catalogue_number if isinstance(catalogue_number, list) else [catalogue_number]
+    cat_text = "+".join(cat_nums)
+
+    if comment:
+        m = audit.IMAGE_ID_REGEX.search(comment)
+        att_loc = m.group(1).strip() if m else comment.strip()
+        if inventory.location_attached(inv, att_loc):
+            return path, st, "move", cat_text, 0, 0, f"Image ID {att_loc} attached"
+        return path, st, "skip", cat_text, 0, 0, f"Image ID {att_loc} not attached in Specify"
+
+    unknown = [c for c in cat_nums if not inventory.has_col_obj(inv, c)]
+    if unknown:
+        return path, st, "skip", cat_text, 0, 0, f"no collection object for {', '.join(unknown)}"
+
+    if len(cat_nums) > 1:
+        # Shared asset: one upload and a PUT per object; split: one upload and PUT per copy
+        if os.getenv("SPLIT_SHARED_ASSET") == "1":
+            return path, st, "split", cat_text, st.st_size, 1 + len(cat_nums), "shared asset"
+        return path, st, "split", cat_text, st.st_size * len(cat_nums), 2 * len(cat_nums), f"{len(cat_nums)} copies"
+
+    # One asset server upload and one collection object PUT
+    if inventory.is_attached(inv, cat_text, path.name):
+        return path, st, "replace", cat_text, st.st_size, 2, "same filename attached"
+    return path, st, "upload", cat_text, st.st_size, 2, ""
+
+
+def build(scan_root=None, workers=None):
+    """Classify every file of SCAN_DIR and store the plan, replacing the previous one. Returns summary()."""
+    scan_root = scan_root or controller.scan_root()
+    workers = workers or int(os.getenv("AUDIT_WORKERS", "8"))
+    inv = inventory.open_inventory()
+    index = state.open_index()
+    conn = open_plan()
+    if inventory.is_empty(inv):
+        log.warning("The inventory mirror is empty, every file will be planned as skipped (run cli.py inventory first).")
+
+    planned = []
+    try:
+        items = scanner.scan(scan_root)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while chunk := list(islice(items, READ_CHUNK)):
+                # Only the EXIF reads run in the pool, the SQLite lookups stay on this thread
+                chunk = [(path, st, state.lookup(index, path, st)) for path, st in chunk]
+                for (path, st, known), comment in zip(chunk, executor.map(_read_comment, chunk)):
+                    planned.append(_classify(path, st, comment, inv))
+    finally:
+        index.close()
+        inv.close()
+    planned.sort(key=lambda p: (ACTIONS.index(p[2]), str(p[0])))
+
+    now = time.time()
+    conn.execute("DELETE FROM plan")
+    conn.executemany(
+        "INSERT INTO plan (path, action, cat_nums, size, mtime_ns, bytes, requests, reason, status, updated) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(str(path), action, cat_text, st.st_size, st.st_mtime_ns, size, requests, reason,
+          "skipped" if action == "skip" else "pending", now)
+         for path, st, action, cat_text, size, requests, reason in planned],
+    )
+    conn.commit()
+    try:
+        return summary(conn)
+    finally:
+        conn.close()
+
+
+def summary(conn) -> dict:
+    """Actions, bytes and requests of the stored plan, with the statuses of its rows."""
+    actions = {
+        row["action"]: {"files": row["files"], "bytes": row["bytes"] or 0, "requests": row["requests"] or 0}
+        for row in conn.execute(
+            "SELECT action, COUNT(*) AS files, SUM(bytes) AS bytes, SUM(requests) AS requests FROM plan GROUP BY action"
+        )
+    }
+    statuses = {row["status"]: row["n"] for row in conn.execute("SELECT status, COUNT(*) AS n FROM plan GROUP BY status")}
+    attaching = sum(actions.get(a, {}).get("files", 0) for a in ("replace", "upload", "split"))
+    cat_nums = conn.execute(
+        "SELECT SUM(LENGTH(cat_nums) - LENGTH(REPLACE(cat_nums, '+', '')) + 1) FROM plan WHERE action IN ('replace', 'upload', 'split')"
+    ).fetchone()[0] or 0
+    # Login and upload settings, plus the batched upload params and collection object lookups
+    batched = 0
+    if attaching:
+        batched = 2 + math.ceil(attaching / int(os.getenv("UPLOAD_PARAMS_BATCH", "100"))) \
+            + math.ceil(cat_nums / int(os.getenv("COL_OBJ_BATCH", "100")))
+    return {
+        "actions": actions,
+        "statuses": statuses,
+        "bytes": sum(a["bytes"] for a in actions.values()),
+        "requests": sum(a["requests"] for a in actions.values()) + batched,
+    }
+
+
+def write_report(conn, report_csv: Path):
+    """Write the stored plan, one row per file in execution order."""
+    try:
+        with report_csv.open("w", newline="", encoding="utf-8") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["seq", "action", "path", "catalogue_numbers", "bytes", "requests", "reason", "status"])
+            for row in conn.execute("SELECT * FROM plan ORDER BY seq"):
+                writer.writerow([row["seq"], row["action"], row["path"], row["cat_nums"], row["bytes"],
+                                 row["requests"], row["reason"], row["status"]])
+        log.info("Wrote plan: %s", report_csv)
+    except Exception:
+        log.exception("Failed to write plan: %s", report_csv)
+
+
+def _set_status(conn, statuses):
+    conn.executemany("UPDATE plan SET status = ?, updated = ? WHERE seq = ?",
+                     [(status, time.time(), seq) for seq, status in statuses])
+    conn.commit()
+
+
+def _outcome_status(outcome):
+    if outcome == "attached":
+        return "done"
+    if outcome in state.SKIP_OUTCOMES:
+        return "skipped"
+    return "failed"
+
+
+def _moved_already(row, path):
+    """True when an interrupted run already moved the file of a move row to UPLOADED_DIR."""
+    try:
+        st = helpers.uploaded_path(path).stat()
+    except OSError:
+        return False
+    return (st.st_size, st.st_mtime_ns) == (row["size"], row["mtime_ns"])
+
+
+def _run_batch(rows, session, index, workers):
+    """Run one batch of plan rows, returns (seq, status) for each."""
+    statuses = []
+    to_sync = []
+    for row in rows:
+        path = Path(row["path"])
+        # A batch interrupted earlier may have synced (and moved) the file after the plan was built
+        outcome = state.outcome_since(index, path, row["size"], row["mtime_ns"], row["updated"])
+        if outcome == "attached" or outcome in state.SKIP_OUTCOMES:
+            statuses.append((row["seq"], _outcome_status(outcome)))
+            continue
+        try:
+            st = path.stat()
+        except OSError:
+            moved = row["action"] == "move" and _moved_already(row, path)
+            statuses.append((row["seq"], "done" if moved else "stale"))
+            continue
+        if (st.st_size, st.st_mtime_ns) != (row["size"], row["mtime_ns"]):
+            # Changed since the plan was built, build it again to include it
+            statuses.append((row["seq"], "stale"))
+        elif row["action"] == "move":
+            statuses.append((row["seq"], "done" if helpers.move_to_uploaded_dir(path) else "failed"))
+        else:
+            to_sync.append((row, path, st))
+
+    if to_sync:
+        started = time.time()
+        controller.sync_paths([(path, st) for _, path, st in to_sync], session, index, workers)
+        for row, path, st in to_sync:
+            # Only what this sync recorded counts, not an outcome left by an earlier run
+            outcome = state.outcome_since(index, path, st.st_size, st.st_mtime_ns, started)
+            if outcome is None and state.is_unchanged_skip(index, path, st):
+                # Skipped by sync_paths without a new record
+                statuses.append((row["seq"], "skipped"))
+            else:
+                statuses.append((row["seq"], _outcome_status(outcome)))
+    return statuses
+
+
+def execute(batch_size=None, workers=None):
+    """Run the pending actions of the stored plan in order. Returns summary()."""
+    batch_size = batch_size or int(os.getenv("PLAN_BATCH", "100"))
+    conn = open_plan()
+    try:
+        pending = conn.execute("SELECT COUNT(*) FROM plan WHERE status = 'pending'").fetchone()[0]
+        if not pending:
+            log.info("No pending actions in the plan.")
+            return summary(conn)
+
+        metrics.reset()
+        with metrics.stage("login"):
+            session = client.api_login()
+        if session is None:
+            log.error("Login failed, plan not executed.")
+            return summary(conn)
+        index = state.open_index()
+        done = 0
+        try:
+            while True:
+                rows = conn.execute(
+                    "SELECT * FROM plan WHERE status = 'pending' ORDER BY seq LIMIT ?", (batch_size,)
+                ).fetchall()
+                if not rows:
+                    break
+                # Statuses are stored after every batch, a new execute() continues from the next one
+                _set_status(conn, _run_batch(rows, session, index, workers))
+                done += len(rows)
+                log.info("Plan: %s / %s actions run.", done, pending)
+        except transport.HostUnavailable as e:
+            # The batch that was running stays pending, execute() again resumes with it
+            log.error(" !!!! Plan execution stopped: %s", e)
+        finally:
+            index.close()
+            metrics.export()
+        return summary(conn)
+    finally:
+        conn.close()
+
+
+def log_summary(plan_summary):
+    for action in ACTIONS:
+        totals = plan_summary["actions"].get(action)
+        if totals:
+            log.info("Plan %s: %s files, %.1f MB, %s requests", action, totals["files"], totals["bytes"] / 1e6, totals["requests"])
+    log.info("Plan total: %.1f MB, about %s requests. Statuses: %s",
+             plan_summary["bytes"] / 1e6, plan_summary["requests"], plan_summary["statuses"])
+
+
+# Dry run: refresh the inventory mirror (unless no_refresh), build the plan and log its size
+# Writes the plan as CSV to report_csv when given
+def plan(report_csv=None, no_refresh=False, workers=None):
+    if not no_refresh:
+        session = client.api_login()
+        if session is None:
+            log.error("Login failed, inventory not refreshed.")
+            return
+        inv = inventory.open_inventory()
+        try:
+            refreshed = inventory.refresh(inv, session)
+        finally:
+            inv.close()
+        if refreshed is None:
+            return
+    plan_summary = build(workers=workers)
+    log_summary(plan_summary)
+    if report_csv:
+        conn = open_plan()
+        try:
+            write_report(conn, Path(report_csv))
+        finally:
+            conn.close()
+    return plan_summary
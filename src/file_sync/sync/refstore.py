@@ -0,0 +1,221 @@
+import csv
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+
+# Indexed local copy of the reference CSVs used by the audit (attachment_list.csv, ...), so lookups
+# and status updates touch single rows instead of loading and rewriting whole CSVs.
+# A source is re-imported only when its size or mtime changed; if the file only grew (rows appended,
+# the bytes already imported are unchanged) just the new rows are read.
+# Location is REFSTORE_DB in .env, default refstore.sqlite3 next to the .env file.
+ROOT = Path(__file__).resolve().parents[3]
+
+# Indexed columns c0..c3 (0 based CSV columns), the whole row is kept as CSV text in "data"
+COLUMNS = ("c0", "c1", "c2", "c3")
+# Bytes hashed to check that an imported part of a source did not change
+CHECK_BYTES = 4096
+IMPORT_BATCH = 5000
+
+_lock = threading.Lock()
+
+
+def open_store(db_path=None) -> sqlite3.Connection:
+    """Open (and create if needed) the reference store."""
+    db_path = db_path or os.getenv("REFSTORE_DB") or ROOT / "refstore.sqlite3"
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS sources (
+            name TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            head_hash TEXT,
+            tail_hash TEXT
+        );
+        CREATE TABLE IF NOT EXISTS rows (
+            source TEXT NOT NULL,
+            rownum INTEGER NOT NULL,
+            c0 TEXT, c1 TEXT, c2 TEXT, c3 TEXT,
+            data TEXT NOT NULL,
+            status TEXT,
+            PRIMARY KEY (source, rownum)
+        );
+        CREATE INDEX IF NOT EXISTS rows_c0 ON rows (source, c0, rownum);
+        CREATE INDEX IF NOT EXISTS rows_c2 ON rows (source, c2, rownum);
+        CREATE INDEX IF NOT EXISTS rows_c3 ON rows (source, c3, rownum);
+        """
+    )
+    conn.commit()
+    return conn
+
+
+def _hash_range(fh, start, end):
+    fh.seek(start)
+    return hashlib.sha1(fh.read(end - start)).hexdigest()
+
+
+def _row_text(row):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue().rstrip("\r\n")
+
+
+def _read_rows(fh, offset, first_rownum):
+    """
+    Yield (rownum, row, offset after the row, complete) from the binary file fh, starting at offset.
+    complete is False for a last row without a line end, which may still be extended.
+    """
+    fh.seek(offset)
+    state = {"offset": offset, "complete": True}
+
+    def lines():
+        while True:
+            line = fh.readline()
+            if not line:
+                return
+            state["offset"] = fh.tell()
+            state["complete"] = line.endswith(b"\n")
+            yield line.decode("utf-8-sig" if state["offset"] == len(line) else "utf-8")
+
+    for rownum, row in enumerate(csv.reader(lines()), start=first_rownum):
+        yield rownum, row, state["offset"], state["complete"]
+
+
+def _import(conn, name, path: Path, st, offset, first_rownum):
+    """Insert the rows of path from offset on and store the new import position, returns the rows added."""
+    committed_offset, committed_rows = offset, first_rownum
+    batch = []
+
+    def flush():
+        conn.executemany(
+            "INSERT OR REPLACE INTO rows (source, rownum, c0, c1, c2, c3, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            batch,
+        )
+        batch.clear()
+
+    with path.open("rb") as fh:
+        for rownum, row, row_end, complete in _read_rows(fh, offset, first_rownum):
+            cols = [row[i].strip() if len(row) > i else "" for i in range(len(COLUMNS))]
+            batch.append((name, rownum, *cols, _row_text(row)))
+            if complete:
+                committed_offset, committed_rows = row_end, rownum + 1
+            if len(batch) >= IMPORT_BATCH:
+                flush()
+        if batch:
+            flush()
+        head_hash = _hash_range(fh, 0, min(CHECK_BYTES, committed_offset))
+        tail_hash = _hash_range(fh, max(0, committed_offset - CHECK_BYTES), committed_offset)
+
+    conn.execute(
+        "INSERT OR REPLACE INTO sources (name, path, size, mtime_ns, offset, rows, head_hash, tail_hash) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (name, str(path), st.st_size, st.st_mtime_ns, committed_offset, committed_rows, head_hash, tail_hash),
+    )
+    return committed_rows - first_rownum
+
+
+def _appended_only(path: Path, st, source):
+    """True when the already imported bytes of path are unchanged and it only grew."""
+    offset = source["offset"]
+    if str(path) != source["path"] or st.st_size < offset:
+        return False
+    with path.open("rb") as fh:
+        return (_hash_range(fh, 0, min(CHECK_BYTES, offset)) == source["head_hash"]
+                and _hash_range(fh, max(0, offset - CHECK_BYTES), offset) == source["tail_hash"])
+
+
+def sync_source(conn, name, path: Path) -> bool:
+    """
+    Bring source name up to date with the CSV at path. Returns False if the source is not
+    available (file missing and nothing imported before), True otherwise.
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        with _lock:
+            known = conn.execute("SELECT 1 FROM sources WHERE name = ?", (name,)).fetchone()
+        return known is not None
+
+    with _lock:
+        source = conn.execute("SELECT * FROM sources WHERE name = ?", (name,)).fetchone()
+        if source is not None and str(path) == source["path"] \
+                and (source["size"], source["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+            return True
+
+        if source is not None and _appended_only(path, st, source):
+            _import(conn, name, path, st, source["offset"], source["rows"])
+            conn.commit()
+            return True
+
+        # Changed in place: import again, keeping the statuses set by earlier audits
+        statuses = conn.execute(
+            "SELECT c0, status FROM rows WHERE source = ? AND status IS NOT NULL", (name,)
+        ).fetchall()
+        conn.execute("DELETE FROM rows WHERE source = ?", (name,))
+        _import(conn, name, path, st, 0, 0)
+        conn.executemany(
+            "UPDATE rows SET status = ? WHERE source = ? AND c0 = ?",
+            [(row["status"], name, row["c0"]) for row in statuses],
+        )
+        conn.commit()
+    return True
+
+
+def first_by(conn, name, column, value, min_rownum=0, last=False):
+    """The first (or last) row of source name whose column equals value, or None."""
+    if column not in COLUMNS:
+        raise ValueError(f"Not an indexed column: {column}")
+    order = "DESC" if last else "ASC"
+    with _lock:
+        return conn.execute(
+            f"SELECT * FROM rows WHERE source = ? AND {column} = ? AND rownum >= ? ORDER BY rownum {order} LIMIT 1",
+            (name, value, min_rownum),
+        ).fetchone()
+
+
+def contains(conn, name, column, value) -> bool:
+    return first_by(conn, name, column, value) is not None
+
+
+def set_statuses(conn, name, statuses):
+    """Set the status of rows, statuses is a list of (rownum, status)."""
+    with _lock:
+        conn.executemany(
+            "UPDATE rows SET status = ? WHERE source = ? AND rownum = ?",
+            [(status, name, rownum) for rownum, status in statuses],
+        )
+        conn.commit()
+
+
+def export(conn, name, path: Path, status_column=3):
+    """Write source name to path as CSV, with the stored statuses in status_column."""
+    tmp = path.with_name(path.name + ".tmp")
+    with _lock:
+        cursor = conn.execute("SELECT data, status FROM rows WHERE source = ? ORDER BY rownum", (name,))
+        with tmp.open("w", newline="", encoding="utf-8") as fh:
+            writer = csv.writer(fh)
+            for row in cursor:
+                values = next(csv.reader([row["data"]]), [])
+                if row["status"] is not None:
+                    if len(values) <= status_column:
+                        values.extend([""] * (status_column + 1 - len(values)))
+                    values[status_column] = row["status"]
+                writer.writerow(values)
+        os.replace(tmp, path)
+
+        # Exported over the source itself: the statuses are now part of the rows, import it again
+        # so the stored offsets and hashes match the new file
+        source = conn.execute("SELECT path FROM sources WHERE name = ?", (name,)).fetchone()
+        if source is not None and Path(source["path"]) == path:
+            conn.execute("DELETE FROM rows WHERE source = ?", (name,))
+            _import(conn, name, path, path.stat(), 0, 0)
+            conn.commit()
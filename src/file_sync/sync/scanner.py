@@ -0,0 +1,168 @@
+import fnmatch
+import logging
+import os
+import queue
+import stat
+import threading
+from pathlib import Path
+
+
+# Directory scanner for SCAN_DIR, built on os.scandir so each entry costs one stat at most
+# (none for directories, and on Windows the listing already carries the stat).
+# Recursive scans list the subdirectories in parallel and hand files to the caller while the walk
+# is still running, so the sync starts uploading before a large archive has been fully listed.
+#   SCAN_RECURSIVE  1 to descend into subdirectories (default 0, only SCAN_DIR itself)
+#   SCAN_INCLUDE    comma separated patterns, only matching files are returned (e.g. "*.jpg,*.tif")
+#   SCAN_EXCLUDE    comma separated patterns for files and directories to skip (e.g. "thumbs/*,*.db")
+#   SCAN_WORKERS    threads listing directories in a recursive scan (default 4)
+# Patterns match the entry name or its path relative to SCAN_DIR, with "/" as separator.
+# UPLOADED_DIR is never descended into when it lies inside SCAN_DIR.
+
+log = logging.getLogger(__name__)
+
+# Temp files written next to the images while their EXIF is updated
+TEMP_SUFFIXES = (".tmp_exif",)
+# Files handed from a listing thread to the caller at a time
+SCAN_BATCH = 256
+
+_DONE = object()
+
+
+def _patterns(value):
+    return [p.strip() for p in (value or "").split(",") if p.strip()]
+
+
+def _matches(name, rel, patterns):
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel, p) for p in patterns)
+
+
+def _entries(directory, rel, recursive, include, exclude, skip_dirs):
+    """
+    Yield (path, stat) for the files of one directory, and (None, (path, rel)) for the
+    subdirectories to scan next.
+    """
+    try:
+        it = os.scandir(directory)
+    except OSError as e:
+        log.error("Cannot list %s: %s", directory, e)
+        return
+    with it:
+        for entry in it:
+            entry_rel = f"{rel}/{entry.name}" if rel else entry.name
+            try:
+                # Symlinked directories are not followed, they could loop
+                if entry.is_dir(follow_symlinks=False):
+                    if (recursive and not _matches(entry.name, entry_rel, exclude)
+                            and os.path.normcase(os.path.abspath(entry.path)) not in skip_dirs):
+                        yield None, (entry.path, entry_rel)
+                    continue
+                if entry.name.endswith(TEMP_SUFFIXES):
+                    continue
+                if include and not _matches(entry.name, entry_rel, include):
+                    continue
+                if exclude and _matches(entry.name, entry_rel, exclude):
+                    continue
+                st = entry.stat()
+            except OSError:
+                # Removed meanwhile or a broken symlink
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield (Path(entry.path), st), None
+
+
+def _walk(root, options):
+    stack = [(str(root), "")]
+    while stack:
+        directory, rel = stack.pop()
+        for found, subdir in _entries(directory, rel, *options):
+            if subdir is not None:
+                stack.append(subdir)
+            else:
+                yield found
+
+
+def _walk_parallel(root, workers, options):
+    dirs = queue.Queue()
+    # Bounded, so the listing threads wait when the pipeline is slower than the walk
+    out = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = 1  # directories queued or being listed
+    dirs.put((str(root), ""))
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def list_dirs():
+        nonlocal pending
+        while True:
+            item = dirs.get()
+            if item is None:
+                return
+            try:
+                batch = []
+                for found, subdir in _entries(item[0], item[1], *options):
+                    if stop.is_set():
+                        break
+                    if subdir is not None:
+                        with lock:
+                            pending += 1
+                        dirs.put(subdir)
+                        continue
+                    batch.append(found)
+                    if len(batch) >= SCAN_BATCH:
+                        put(batch)
+                        batch = []
+                if batch:
+                    put(batch)
+            finally:
+                with lock:
+                    pending -= 1
+                    finished = pending == 0
+                if finished:
+                    put(_DONE)
+
+    threads = [threading.Thread(target=list_dirs, name=f"scan-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            batch = out.get()
+            if batch is _DONE:
+                return
+            yield from batch
+    finally:
+        # Also reached when the caller stops iterating early
+        stop.set()
+        for _ in threads:
+            dirs.put(None)
+
+
+def scan(root, recursive=None, include=None, exclude=None, workers=None):
+    """
+    Yield (path, stat) for the regular files under root, streamed while the walk runs.
+    Arguments left as None are read from SCAN_RECURSIVE, SCAN_INCLUDE, SCAN_EXCLUDE and SCAN_WORKERS.
+    The order of the files is not defined.
+    """
+    if recursive is None:
+        recursive = os.getenv("SCAN_RECURSIVE") == "1"
+    if include is None:
+        include = _patterns(os.getenv("SCAN_INCLUDE"))
+    if exclude is None:
+        exclude = _patterns(os.getenv("SCAN_EXCLUDE"))
+    if workers is None:
+        workers = int(os.getenv("SCAN_WORKERS", "4"))
+
+    skip_dirs = set()
+    if os.getenv("UPLOADED_DIR"):
+        skip_dirs.add(os.path.normcase(os.path.abspath(os.getenv("UPLOADED_DIR"))))
+    options = (recursive, include, exclude, skip_dirs)
+
+    if recursive and workers > 1:
+        return _walk_parallel(root, workers, options)
+    return _walk(root, options)
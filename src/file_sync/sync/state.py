@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+# Persistent index of scanned files, so rescans can skip unchanged files with a single stat.
+# Location is STATE_DB in .env, default sync_state.sqlite3 next to the .env file.
+ROOT = Path(__file__).resolve().parents[3]
+
+# Last outcomes after which an unchanged file needs no further work
+SKIP_OUTCOMES = ("invalid", "has_image_id")
+
+_lock = threading.Lock()
+
+
+def open_index(db_path=None) -> sqlite3.Connection:
+    """Open (and create if needed) the state index."""
+    db_path = db_path or os.getenv("STATE_DB") or ROOT / "sync_state.sqlite3"
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            cat_num TEXT,
+            valid INTEGER,
+            image_id TEXT,
+            outcome TEXT,
+            updated REAL
+        )
+        """
+    )
+    conn.commit()
+    return conn
+
+
+def lookup(conn, path: Path, st: os.stat_result):
+    """Return the stored row for path if its size and mtime did not change since, else None."""
+    with _lock:
+        row = conn.execute("SELECT * FROM files WHERE path = ?", (str(path),)).fetchone()
+    if row is None or row["size"] != st.st_size or row["mtime_ns"] != st.st_mtime_ns:
+        return None
+    return row
+
+
+def is_unchanged_skip(conn, path: Path, st: os.stat_result) -> bool:
+    """True when the file is unchanged since it was last skipped (invalid name or ImageID already set)."""
+    row = lookup(conn, path, st)
+    return row is not None and row["outcome"] in SKIP_OUTCOMES
+
+
+def record(conn, path: Path, st: os.stat_result | None, cat_num, valid, image_id, outcome):
+    """Store the parsed values and last outcome for path, keyed by its size and mtime at scan time."""
+    if st is None:
+        try:
+            st = path.stat()
+        except OSError:
+            return
+    if isinstance(cat_num, list):
+        cat_num = "+".join(cat_num)
+    with _lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, cat_num, valid, image_id, outcome, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(path), st.st_size, st.st_mtime_ns, cat_num, int(bool(valid)), image_id, outcome, time.time()),
+        )
+        conn.commit()
+
+
+def outcome_since(conn, path: Path, size, mtime_ns, since):
+    """
+    The outcome recorded for path at this size and mtime at or after since (a time.time() value),
+    or None. The file itself may be gone meanwhile (attached files are moved to UPLOADED_DIR).
+    """
+    with _lock:
+        row = conn.execute(
+            "SELECT outcome FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND updated >= ?",
+            (str(path), size, mtime_ns, since),
+        ).fetchone()
+    return row["outcome"] if row else None
@@ -1,5 +1,6 @@
 from pathlib import Path
 import re
+import struct
 import piexif
 from PIL import Image
 
@@ -35,19 +36,93 @@ PREFIXES = {
     b"JIS\x00\x00\x00\x00\x00": "shift_jis",
 }
 
-def read_image_id(path: str | Path) -> str | None:
-    """
-    Returns the EXIF UserComment (what you wrote as b'ASCII\\0\\0\\0' + bytes),
-    or None if missing/unsupported.
-    Works for JPEG/TIFF that contain EXIF.
-    """
-    p = Path(path)
-    try:
-        exif = piexif.load(str(p))
-    except Exception:
+USER_COMMENT_TAG = 0x9286      # piexif.ExifIFD.UserComment
+EXIF_IFD_POINTER_TAG = 0x8769  # piexif.ImageIFD.ExifTag
+
+
+def _find_ifd_entry(f, base, endian, ifd_offset, tag):
+    """Return (type, count, 4 value bytes) of tag in the IFD at ifd_offset, or None."""
+    f.seek(base + ifd_offset)
+    (num_entries,) = struct.unpack(endian + "H", f.read(2))
+    entries = f.read(12 * num_entries)
+    for i in range(num_entries):
+        entry_tag, entry_type, count = struct.unpack_from(endian + "HHI", entries, i * 12)
+        if entry_tag == tag:
+            return entry_type, count, entries[i * 12 + 8:i * 12 + 12]
+    return None
+
+
+def _read_tiff_user_comment(f, base) -> bytes | None:
+    """Read the raw UserComment from a TIFF structure that starts at file offset base."""
+    f.seek(base)
+    header = f.read(8)
+    if header[:2] == b"II":
+        endian = "<"
+    elif header[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Not a TIFF header")
+    magic, ifd0_offset = struct.unpack(endian + "HI", header[2:8])
+    if magic != 42:
+        raise ValueError("Not a TIFF header")
+
+    exif_pointer = _find_ifd_entry(f, base, endian, ifd0_offset, EXIF_IFD_POINTER_TAG)
+    if exif_pointer is None:
+        return None
+    (exif_ifd_offset,) = struct.unpack(endian + "I", exif_pointer[2])
+
+    user_comment = _find_ifd_entry(f, base, endian, exif_ifd_offset, USER_COMMENT_TAG)
+    if user_comment is None:
         return None
+    _type, count, value = user_comment
+    if count <= 4:
+        return value[:count]
+    (value_offset,) = struct.unpack(endian + "I", value)
+    f.seek(base + value_offset)
+    return f.read(count)
+
+
+def _read_jpeg_user_comment(f) -> bytes | None:
+    """Walk the JPEG markers up to the image data and read the UserComment from the APP1/EXIF segment."""
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Unexpected JPEG marker")
+        while marker[1] == 0xFF:  # fill bytes
+            marker = marker[1:] + f.read(1)
+        code = marker[1]
+        if code in (0xD9, 0xDA):  # EOI / start of scan - no EXIF before the image data
+            return None
+        if 0xD0 <= code <= 0xD7 or code == 0x01:  # markers without a length
+            continue
+        (length,) = struct.unpack(">H", f.read(2))
+        if code == 0xE1 and f.read(6) == b"Exif\x00\x00":
+            return _read_tiff_user_comment(f, f.tell())
+        elif code == 0xE1:
+            f.seek(length - 2 - 6, 1)
+        else:
+            f.seek(length - 2, 1)
+
 
-    raw = exif.get("Exif", {}).get(piexif.ExifIFD.UserComment)
+def _read_user_comment(p: Path) -> bytes | None:
+    """
+    Read only the header bytes needed to get the raw EXIF UserComment.
+    Raises ValueError for layouts this reader does not handle (e.g. WebP).
+    """
+    with p.open("rb") as f:
+        magic = f.read(4)
+        if magic[:2] == b"\xff\xd8":
+            return _read_jpeg_user_comment(f)
+        if magic in (b"II*\x00", b"MM\x00*"):
+            return _read_tiff_user_comment(f, 0)
+        if magic == b"RIFF":
+            raise ValueError("WebP is read with piexif")
+    # Not an image format that carries EXIF
+    return None
+
+
+def _decode_user_comment(raw) -> str | None:
     if not raw:
         return None
 
@@ -72,4 +147,23 @@ def read_image_id(path: str | Path) -> str | None:
     return str(raw).strip() or None
 
 
+def read_image_id(path: str | Path) -> str | None:
+    """
+    Returns the EXIF UserComment (what you wrote as b'ASCII\\0\\0\\0' + bytes),
+    or None if missing/unsupported.
+    Works for JPEG/TIFF that contain EXIF. Only the JPEG markers / TIFF IFDs and the
+    UserComment bytes are read; unusual layouts fall back to a full piexif.load.
+    """
+    p = Path(path)
+    try:
+        raw = _read_user_comment(p)
+    except OSError:
+        return None
+    except Exception:
+        try:
+            exif = piexif.load(str(p))
+        except Exception:
+            return None
+        raw = exif.get("Exif", {}).get(piexif.ExifIFD.UserComment)
 
+    return _decode_user_comment(raw)
@@ -0,0 +1,176 @@
+import os
+import queue
+import time
+from pathlib import Path
+import logging
+
+from api import client
+from sync import controller
+from sync import state
+from sync import metrics
+from sync.scanner import TEMP_SUFFIXES
+
+# watchdog (inotify on Linux) is optional, without it the directory is polled
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+# Logging is set up once per run by runlog.setup()
+log = logging.getLogger(__name__)
+
+
+class _EventQueueHandler(FileSystemEventHandler):
+    """Put the paths of created, modified and moved-in files on a queue."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.events.put(Path(event.src_path))
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.events.put(Path(event.src_path))
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.events.put(Path(event.dest_path))
+
+
+def _list_files(root):
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield Path(entry.path)
+
+
+def _settled(candidates, settle_seconds):
+    """
+    Update candidates (path -> (size, mtime_ns, stable since)) from a fresh stat and
+    return the paths whose size and mtime did not change for settle_seconds.
+    """
+    now = time.monotonic()
+    ready = []
+    for path, (size, mtime_ns, stable_since) in list(candidates.items()):
+        try:
+            st = path.stat()
+        except OSError:
+            # Moved away or deleted meanwhile
+            del candidates[path]
+            continue
+        if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            candidates[path] = (st.st_size, st.st_mtime_ns, now)
+        elif now - stable_since >= settle_seconds:
+            ready.append(path)
+            del candidates[path]
+    return ready
+
+
+# Long running sync of SCAN_DIR: new files are uploaded once their size stops changing
+# Uses inotify through watchdog when installed, else (or with WATCH_POLLING=1, e.g. on SMB mounts)
+# lists the directory every WATCH_POLL_SECONDS (default 10)
+# A file is uploaded after its size and mtime are unchanged for WATCH_SETTLE_SECONDS (default 5)
+# A file that failed (or whose batch raised, e.g. Specify unreachable) is tried again after
+# WATCH_RETRY_SECONDS (default 30), doubling on every failure up to WATCH_RETRY_MAX_SECONDS (default 900)
+def watch(workers=None):
+    root = controller.scan_root()
+    settle_seconds = float(os.getenv("WATCH_SETTLE_SECONDS", "5"))
+    poll_seconds = float(os.getenv("WATCH_POLL_SECONDS", "10"))
+    retry_seconds = float(os.getenv("WATCH_RETRY_SECONDS", "30"))
+    retry_max_seconds = float(os.getenv("WATCH_RETRY_MAX_SECONDS", "900"))
+    polling = Observer is None or os.getenv("WATCH_POLLING") == "1"
+
+    session = client.api_login()
+    index = state.open_index()
+    candidates = {}
+    # Files synced successfully, path -> (size, mtime_ns) at that time
+    handled = {}
+    # Files that failed, path -> (failures, monotonic time of the next try)
+    retries = {}
+
+    def add_candidate(path):
+        if path.name.endswith(TEMP_SUFFIXES) or path.parent != root:
+            return
+        if path in retries and retries[path][1] > time.monotonic():
+            return
+        try:
+            st = path.stat()
+        except OSError:
+            return
+        if handled.get(path) == (st.st_size, st.st_mtime_ns) or path in candidates:
+            return
+        candidates[path] = (st.st_size, st.st_mtime_ns, time.monotonic())
+
+    # Files that were already waiting when the watch started
+    for path in _list_files(root):
+        add_candidate(path)
+
+    events = queue.Queue()
+    observer = None
+    if polling:
+        log.info("Watching %s by polling every %s seconds", root, poll_seconds)
+    else:
+        observer = Observer()
+        observer.schedule(_EventQueueHandler(events), str(root), recursive=False)
+        observer.start()
+        log.info("Watching %s with inotify", root)
+
+    last_poll = time.monotonic()
+    try:
+        while True:
+            time.sleep(1)
+            if polling and time.monotonic() - last_poll >= poll_seconds:
+                last_poll = time.monotonic()
+                for path in _list_files(root):
+                    add_candidate(path)
+            while not events.empty():
+                add_candidate(events.get_nowait())
+            for path in [p for p, (_, retry_at) in retries.items() if retry_at <= time.monotonic()]:
+                add_candidate(path)
+
+            ready = _settled(candidates, settle_seconds)
+            if not ready:
+                continue
+            seen = {}
+            for path in ready:
+                try:
+                    seen[path] = path.stat()
+                except OSError:
+                    pass
+            try:
+                count, count_attach, _ = controller.sync_paths(ready, session, index, workers)
+                log.info("Watch: %s new files processed, %s attachments made.", count, count_attach)
+                synced = True
+            except Exception:
+                log.exception("Watch: syncing %s files failed, they will be tried again.", len(ready))
+                synced = False
+            metrics.export()
+
+            # A file is handled once its outcome for this version of it is stored, else it is retried later
+            for path, st in seen.items():
+                row = state.lookup(index, path, st) if synced else None
+                if row is not None and (row["outcome"] == "attached" or row["outcome"] in state.SKIP_OUTCOMES):
+                    handled[path] = (st.st_size, st.st_mtime_ns)
+                    retries.pop(path, None)
+                    continue
+                failures = retries.get(path, (0, 0))[0] + 1
+                delay = min(retry_max_seconds, retry_seconds * 2 ** (failures - 1))
+                retries[path] = (failures, time.monotonic() + delay)
+                log.warning("Watch: %s not synced (%s failures), next try in %.0f seconds.", path.name, failures, delay)
+            # Forget files that are gone (uploaded files are moved out of SCAN_DIR)
+            for path in [p for p in handled if not p.exists()]:
+                del handled[path]
+            for path in [p for p in retries if not p.exists()]:
+                del retries[path]
+    except KeyboardInterrupt:
+        log.info("Watch stopped.")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        index.close()